@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+""" Microbenchmark of the per-call cost of the container metadata API.
+
+    Runs against a temporary database, so it can be run on any machine:
+
+      python benchmarks/metadata.py [--calls N] [--containers N]
+
+    The 'legacy' mode replays the previous access pattern (querying the database directly on each
+    call, probing every table before it and closing the connection after it) for comparison.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from peewee import OperationalError, DoesNotExist
+
+from runtime import metadata
+
+def legacyCall(func, *args):
+  """ Calls the given metadata function the way each call was made before the schema was
+      initialized once per process and connections were reused.
+  """
+  for model in metadata.all_models:
+    try:
+      model.select().get()
+    except OperationalError:
+      model.create_table()
+    except DoesNotExist:
+      pass
+
+  try:
+    return func(*args)
+  finally:
+    if not metadata.db.is_closed():
+      metadata.db.close()
+
+
+def legacyGetContainerStatus(container_id):
+  """ Reads the status of the given container straight from the database. """
+  try:
+    return (metadata.ContainerField
+      .select()
+      .join(metadata.Container)
+      .where(metadata.Container.docker_id == container_id, metadata.ContainerField.key == 'status')
+      .get()).value
+  except DoesNotExist:
+    return 'unknown'
+
+
+def legacyGetContainerComponent(container_id):
+  """ Reads the component of the given container straight from the database. """
+  record = metadata._upsertContainerRecord(container_id)
+  return record.component and record.component.name
+
+
+def legacySetContainerStatus(container_id, status):
+  """ Writes the status of the given container straight to the database. """
+  metadata._setContainerFields([container_id], 'status', status)
+
+
+def timeCalls(name, calls, func, legacy):
+  """ Times the given calls of func (with each item of calls as its arguments) and prints the
+      per-call cost.
+  """
+  start = time.time()
+  for args in calls:
+    if legacy:
+      legacyCall(func, *args)
+    else:
+      func(*args)
+
+  # Include the time taken to commit any queued writes.
+  metadata.flushMetadataWrites()
+  duration = time.time() - start
+  print '  %-24s %8.1f us/call' % (name, duration * 1000000.0 / len(calls))
+
+
+def run(mode, calls, containers):
+  legacy = mode == 'legacy'
+  container_ids = ['%064x' % index for index in range(containers)]
+  statuses = [(container_ids[index % containers], 'running') for index in range(calls)]
+  lookups = [(container_ids[index % containers],) for index in range(calls)]
+
+  if legacy:
+    operations = [('setContainerStatus', statuses, legacySetContainerStatus),
+                  ('getContainerStatus', lookups, legacyGetContainerStatus),
+                  ('getContainerComponent', lookups, legacyGetContainerComponent)]
+  else:
+    operations = [('setContainerStatus', statuses, metadata.setContainerStatus),
+                  ('getContainerStatus', lookups, metadata.getContainerStatus),
+                  ('getContainerComponent', lookups, metadata.getContainerComponent)]
+
+  print mode
+  for (name, operation_calls, func) in operations:
+    timeCalls(name, operation_calls, func, legacy)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Container metadata microbenchmark')
+  parser.add_argument('--calls', type=int, default=2000, help='Number of calls per operation')
+  parser.add_argument('--containers', type=int, default=50, help='Number of distinct containers')
+  args = parser.parse_args()
+
+  for mode in ['legacy', 'current']:
+    directory = tempfile.mkdtemp()
+    try:
+      if not metadata.db.is_closed():
+        metadata.db.close()
+
+      metadata.db.init(os.path.join(directory, 'metadata.db'))
+      metadata.db_initialized = False
+      metadata.metadata_cache = metadata.MetadataCache()
+      run(mode, args.calls, args.containers)
+    finally:
+      shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+""" Benchmark of the built-in proxy engine against local echo servers.
+
+    Starts the echo servers and a proxy engine routing a port to them, then measures the round
+    trip latency and throughput of clients talking to the echo servers directly and through the
+    proxy:
+
+      python benchmarks/proxyengine.py [--clients N] [--requests N] [--size BYTES] [--servers N]
+"""
+
+import argparse
+import os
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from proxy.engine import ProxyEngine
+from proxy.portproxy import Route
+
+class EchoHandler(SocketServer.BaseRequestHandler):
+  def handle(self):
+    while True:
+      data = self.request.recv(65536)
+      if not data:
+        return
+
+      self.request.sendall(data)
+
+
+class EchoServer(SocketServer.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+def startEchoServer():
+  """ Starts an echo server on a free local port, returning the port. """
+  server = EchoServer(('127.0.0.1', 0), EchoHandler)
+  thread = threading.Thread(target=server.serve_forever, args=[])
+  thread.daemon = True
+  thread.start()
+  return server.server_address[1]
+
+
+def findFreePort():
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+def runClient(port, requests, size, latencies):
+  """ Sends the given number of requests on a single connection, recording their latencies. """
+  payload = 'x' * size
+  sock = socket.create_connection(('127.0.0.1', port))
+  sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  try:
+    for _ in range(requests):
+      start = time.time()
+      sock.sendall(payload)
+      received = 0
+      while received < size:
+        data = sock.recv(65536)
+        if not data:
+          raise Exception('Connection closed by the server')
+
+        received += len(data)
+
+      latencies.append(time.time() - start)
+  finally:
+    sock.close()
+
+
+def run(name, ports, clients, requests, size):
+  latencies = []
+  threads = [threading.Thread(target=runClient,
+                              args=[ports[index % len(ports)], requests, size, latencies])
+             for index in range(clients)]
+
+  start = time.time()
+  for thread in threads:
+    thread.start()
+
+  for thread in threads:
+    thread.join()
+
+  duration = time.time() - start
+  latencies.sort()
+  total_bytes = 2.0 * size * len(latencies)
+  print '%-8s %8.0f req/s %8.1f MB/s   p50 %7.3f ms   p99 %7.3f ms' % (
+    name, len(latencies) / duration, total_bytes / duration / 1000000.0,
+    latencies[len(latencies) / 2] * 1000.0, latencies[int(len(latencies) * 0.99)] * 1000.0)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Built-in proxy engine benchmark')
+  parser.add_argument('--clients', type=int, default=8, help='Number of concurrent clients')
+  parser.add_argument('--requests', type=int, default=1000, help='Requests per client')
+  parser.add_argument('--size', type=int, default=1024, help='Request size, in bytes')
+  parser.add_argument('--servers', type=int, default=2, help='Number of echo servers')
+  args = parser.parse_args()
+
+  echo_ports = [startEchoServer() for _ in range(args.servers)]
+
+  proxy_port = findFreePort()
+  engine = ProxyEngine()
+  for echo_port in echo_ports:
+    engine.add_route(Route(False, proxy_port, '127.0.0.1', echo_port))
+
+  engine.commit()
+  time.sleep(0.1)
+
+  run('direct', echo_ports, args.clients, args.requests, args.size)
+  run('proxy', [proxy_port], args.clients, args.requests, args.size)
+
+  stats = engine.get_route_stats()[proxy_port]
+  print 'proxy route: %s connections, %s failed, %.3f ms avg connect, %.3f ms max connect' % (
+    stats.connections, stats.failed, stats.get_average_connect_time() * 1000.0,
+    stats.connect_time_max * 1000.0)
+
+  engine.stop()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,4 +1,4 @@
-from object import CFObject, CFField
+from object import CFObject, CFField, ConfigParseException
 from util import pickUnusedPort
 from runtime.metadata import getComponentField, setComponentField
 
@@ -113,16 +113,53 @@ class _Component(CFObject):
   ready_timeout = CFField('readyTimeout').kind(int).default(10000)
   termination_signals = CFField('terminationSignals').list_of(_TerminationSignal).default([])
   privileged = CFField('privileged').kind(bool).default(False)
+  replicas = CFField('replicas').kind(int).default(1)
+  rollout_weights = CFField('rolloutWeights').list_of(int).default([])
+  rollout_step_time = CFField('rolloutStepTime').kind(int).default(30)
+  slow_start = CFField('slowStart').kind(int).default(0)
+  cpuset = CFField('cpuset').default('')
+  cpu_shares = CFField('cpuShares').kind(int).default(0)
+  cpu_quota = CFField('cpuQuota').kind(int).default(0)
+  cpu_period = CFField('cpuPeriod').kind(int).default(0)
+  memory_limit = CFField('memoryLimit').default('')
+  memory_swap_limit = CFField('memorySwapLimit').default('')
+  nofile_limit = CFField('nofileLimit').kind(int).default(0)
+  sysctls = CFField('sysctls').list_of(str).default([])
+  warm_standby = CFField('warmStandby').kind(bool).default(False)
+  warm_standby_started = CFField('warmStandbyStarted').kind(bool).default(False)
   defined_component_links = CFField('defineComponentLinks').list_of(_DefinedComponentLink).default([])
   required_component_links = CFField('requireComponentLinks').list_of(_RequiredComponentLink).default([])
   environment_variables = CFField('environmentVariables').list_of(_EnvironmentVariable).default([])
 
   connection_check = _HealthCheck().build({'kind': 'connection'})
+  docker_ready_check = _HealthCheck().build({'kind': 'docker'})
   termination_checks = CFField('terminationChecks').list_of(_HealthCheck).default([connection_check])
 
   def __init__(self):
     super(_Component, self).__init__('Component')
 
+  @classmethod
+  def build(cls, dictionary):
+    instance = super(_Component, cls).build(dictionary)
+    instance.validate()
+    return instance
+
+  def validate(self):
+    """ Raises a ConfigParseException if the settings of the component are invalid or cannot be
+        used together.
+    """
+    for sysctl in self.sysctls:
+      (name, separator, _) = sysctl.partition('=')
+      if not separator or not name.strip():
+        raise ConfigParseException('Invalid sysctl %s under component %s: expected name=value' %
+                                   (sysctl, self.name))
+
+    # Containers whose bindings reference their own ID get their bindings when started, and
+    # Docker then ignores the host config (and so the resource limits) given on creation.
+    if self.hasContainerIdBindings() and self.getResourceOptions():
+      raise ConfigParseException('Resource limits cannot be used with bindings referencing ' +
+                                 '{container_id} under component ' + str(self.name))
+
   def getFullImage(self):
     """ Returns the full image ID for this component, of the form 'repo:tag' """
     return self.repo + ':' + self.tag
@@ -147,7 +184,7 @@ class _Component(CFObject):
 
   def getReadyCheckTimeout(self):
     """ Returns the maximum amount of time, in seconds, before ready checks time out. """
-    return self.ready_timeout / 1000
+    return self.ready_timeout / 1000.0
 
   def getVolumes(self):
     """ Returns the volumes exposed by this component. """
@@ -160,6 +197,54 @@ class _Component(CFObject):
 
     return {substitute_id(binding.external): binding.volume for binding in self.bindings}
 
+  def hasContainerIdBindings(self):
+    """ Returns whether any of the bindings reference the ID of the container. """
+    return any(['{container_id}' in binding.external for binding in self.bindings])
+
+  def getRolloutWeights(self):
+    """ Returns the percentages of traffic sent to a new container at each step of a rollout,
+        always ending with 100.
+    """
+    weights = [min(100, max(0, weight)) for weight in self.rollout_weights]
+    if weights and weights[-1] != 100:
+      weights.append(100)
+
+    return weights
+
+  def getSysctls(self):
+    """ Returns a dict of the namespaced sysctls to set, from their 'name=value' form. """
+    return dict([sysctl.split('=', 1) for sysctl in self.sysctls])
+
+  def getResourceOptions(self):
+    """ Returns the docker host config options for the resource limits defined. """
+    options = {}
+    if self.cpuset:
+      options['cpuset_cpus'] = self.cpuset
+
+    if self.cpu_shares:
+      options['cpu_shares'] = self.cpu_shares
+
+    if self.cpu_quota:
+      options['cpu_quota'] = self.cpu_quota
+
+    if self.cpu_period:
+      options['cpu_period'] = self.cpu_period
+
+    if self.memory_limit:
+      options['mem_limit'] = self.memory_limit
+
+    if self.memory_swap_limit:
+      options['memswap_limit'] = self.memory_swap_limit
+
+    if self.nofile_limit:
+      options['ulimits'] = [{'name': 'nofile', 'soft': self.nofile_limit,
+                             'hard': self.nofile_limit}]
+
+    if self.sysctls:
+      options['sysctls'] = self.getSysctls()
+
+    return options
+
   def getDefinedComponentLinks(self):
     """ Returns the dict of defined components links. """
     return {l.name: l for l in self.defined_component_links}
@@ -173,9 +258,26 @@ class _Component(CFObject):
     return {v.name: v.value for v in self.environment_variables}
 
 
+class _DockerTimeout(CFObject):
+  """ The timeout of a Docker API operation (e.g. 'create_container'). """
+  operation = CFField('operation').name_field()
+  timeout = CFField('timeout').kind(int).value_field()
+
+  def __init__(self):
+    super(_DockerTimeout, self).__init__('Docker Timeout')
+
+  def getTimeout(self):
+    """ Returns the timeout, in seconds, or None for no timeout. """
+    return self.timeout or None
+
+
 class Configuration(CFObject):
   """ The overall gantry configuration. """
   components = CFField('components').list_of(_Component)
+  image_cache_ttl = CFField('imageCacheTtl').kind(int).default(300)
+  docker_pool_size = CFField('dockerPoolSize').kind(int).default(10)
+  docker_timeouts = CFField('dockerTimeouts').list_of(_DockerTimeout).default([])
+  proxy_engine = CFField('proxyEngine').default('haproxy')
 
   def __init__(self):
     super(Configuration, self).__init__('Configuration')
@@ -186,4 +288,8 @@ class Configuration(CFObject):
       if component.name == name:
         return component
 
-    return None
\ No newline at end of file
+    return None
+
+  def getDockerTimeouts(self):
+    """ Returns a dict of the configured Docker API operation timeouts, by operation. """
+    return {t.operation: t.getTimeout() for t in self.docker_timeouts}
\ No newline at end of file
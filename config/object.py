@@ -29,7 +29,7 @@ class CFObject(object):
     
         Format: 'Name.SubName=Value'
     """
-    (path, value) = override.split('=', 2)
+    (path, value) = override.split('=', 1)
     path_pieces = path.split('.')
     
     # Find the field with the associated name.
@@ -284,6 +284,13 @@ class CFField(object):
     """ Returns the value of the field for the given instance """
     value = self.internal_data(instance)['data'];
     if value is None and self.default_value is not None:
+      # Each instance gets its own copy of a default list, so that changing the list (e.g. with
+      # an override) does not change the default of all the other instances.
+      if isinstance(self.default_value, list):
+        value = list(self.default_value)
+        self.update(instance, value)
+        return value
+
       return self.default_value
 
     return value
@@ -1,4 +1,108 @@
+import threading
+
+# The labels placed on the containers created by gantry.
+LABEL_PROJECT = 'io.gantry.project'
+LABEL_COMPONENT = 'io.gantry.component'
+LABEL_GENERATION = 'io.gantry.generation'
+LABEL_CONFIG_HASH = 'io.gantry.config-hash'
+
+# The container event actions after which a cached inspection of the container is stale.
+INVALIDATING_ACTIONS = set(['start', 'restart', 'die', 'kill', 'stop', 'oom', 'destroy', 'pause',
+                            'unpause', 'update', 'rename', 'health_status', 'connect',
+                            'disconnect'])
+
+class ContainerInspectCache(object):
+  """ Cache of container inspections, keyed by container ID. The cache is only used while
+      the Docker events stream is connected, as the stream is what invalidates it.
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+
+    # The cached inspection results, by container ID.
+    self.entries = {}
+
+    # Whether the cache is enabled (i.e. the events stream is connected).
+    self.enabled = False
+
+    # Incremented on every invalidation, so that an inspection which raced with an
+    # invalidation is not cached.
+    self.generation = 0
+
+  def inspect(self, client, container):
+    """ Returns the inspection information for the given container. """
+    container_id = getContainerId(container)
+    with self.lock:
+      if self.enabled and container_id in self.entries:
+        return self.entries[container_id]
+
+      generation = self.generation
+
+    container_info = client.inspect_container(container_id)
+    with self.lock:
+      if self.enabled and generation == self.generation:
+        self.entries[container_id] = container_info
+
+    return container_info
+
+  def invalidate(self, container_id):
+    """ Removes the cached inspection for the given container ID. """
+    with self.lock:
+      self.generation += 1
+      self.entries.pop(container_id, None)
+
+  def setEnabled(self, enabled):
+    """ Enables or disables the cache. The cache is cleared in either case. """
+    with self.lock:
+      self.generation += 1
+      self.entries = {}
+      self.enabled = enabled
+
+
+inspect_cache = ContainerInspectCache()
+
+
+def getContainerId(container_or_id):
+  """ Returns the ID of the given container dict or ID. """
+  return container_or_id['Id'] if isinstance(container_or_id, dict) else container_or_id
+
+def getContainerLabel(container, label):
+  """ Returns the value of the given label on the given container (as listed by Docker) or
+      None if none.
+  """
+  return (container.get('Labels') or {}).get(label)
+
+def buildLabelFilters(project_name=None, component_name=None):
+  """ Returns the label filters selecting the gantry containers of the given project and
+      component (if any).
+  """
+  filters = [LABEL_COMPONENT + '=' + component_name if component_name else LABEL_COMPONENT]
+  if project_name:
+    filters.append(LABEL_PROJECT + '=' + project_name)
+
+  return filters
+
+def inspectContainer(client, container):
+  """ Returns the (possibly cached) inspection information for the given container. """
+  return inspect_cache.inspect(client, container)
+
 def getContainerIPAddress(client, container):
   """ Returns the IP address on which the container is running. """
-  container_info = client.inspect_container(container)
+  container_info = inspectContainer(client, container)
   return container_info['NetworkSettings']['IPAddress']
+
+def getContainerGateway(client, container):
+  """ Returns the IP address of the gateway (i.e. the host) of the container's network. """
+  container_info = inspectContainer(client, container)
+  return container_info['NetworkSettings']['Gateway']
+
+def handleContainerEvent(event):
+  """ Invalidates the cached inspection of the container referenced by the given Docker
+      event, if any.
+  """
+  container_id = event.getContainerId()
+  if container_id and event.action in INVALIDATING_ACTIONS:
+    inspect_cache.invalidate(container_id)
+
+def handleEventStreamStatus(connected):
+  """ Enables the inspection cache only while the Docker events stream is connected. """
+  inspect_cache.setEnabled(connected)
@@ -0,0 +1,156 @@
+import docker
+import threading
+import time
+
+from functools import partial
+from Queue import Queue, Empty
+
+DOCKER_POOL_SIZE = 10
+DEFAULT_DOCKER_TIMEOUT = 60 # 60 seconds
+
+# The default timeouts, in seconds, of specific Docker API operations. None means no timeout.
+DOCKER_OPERATION_TIMEOUTS = {
+  'containers': 10,
+  'images': 10,
+  'inspect_container': 10,
+  'inspect_image': 10,
+  'create_container': 60,
+  'start': 60,
+  'stop': 120,
+  'kill': 30,
+  'remove_container': 60,
+  'exec_create': 30,
+  'exec_start': 120,
+  'pull': None,
+  'events': None,
+}
+
+# The operations which return streams. These run on a dedicated client, as the connection
+# remains in use after the call returns.
+STREAMING_OPERATIONS = set(['pull', 'push', 'events', 'attach', 'logs', 'build', 'stats'])
+
+class DockerCallStats(object):
+  """ Call count and latency statistics of a single Docker API operation. """
+  def __init__(self):
+    self.count = 0
+    self.errors = 0
+    self.total_time = 0.0
+    self.max_time = 0.0
+
+  def record(self, duration, failed):
+    """ Records a call which took the given time, in seconds. """
+    self.count += 1
+    self.errors += 1 if failed else 0
+    self.total_time += duration
+    self.max_time = max(self.max_time, duration)
+
+  def getAverageTime(self):
+    """ Returns the average time of the calls, in seconds. """
+    return self.total_time / self.count if self.count else 0.0
+
+
+class DockerClientPool(object):
+  """ A bounded pool of docker clients, each with its own connection, shared by all threads.
+      Each API call checks a client out of the pool for its duration, applying the timeout
+      configured for the operation and recording the call's latency.
+  """
+  def __init__(self, size=DOCKER_POOL_SIZE):
+    # The maximum number of clients (and thus concurrent calls to Docker).
+    self.size = size
+
+    # The idle clients and the number of clients created so far.
+    self.idle_clients = Queue()
+    self.created = 0
+
+    # The timeouts, in seconds, of specific operations.
+    self.timeouts = dict(DOCKER_OPERATION_TIMEOUTS)
+
+    # The call statistics, by operation.
+    self.stats = {}
+
+    self.lock = threading.Lock()
+
+  def configure(self, size=None, timeouts=None):
+    """ Updates the size of the pool and/or the timeouts of specific operations. """
+    with self.lock:
+      if size:
+        self.size = size
+
+      if timeouts:
+        self.timeouts.update(timeouts)
+
+  def getTimeout(self, operation):
+    """ Returns the timeout, in seconds, of the given operation (None for no timeout). """
+    return self.timeouts.get(operation, DEFAULT_DOCKER_TIMEOUT)
+
+  def getStats(self):
+    """ Returns a copy of the call statistics, by operation. """
+    with self.lock:
+      return dict(self.stats)
+
+  def acquire(self):
+    """ Checks a client out of the pool, creating one if the pool is not yet full or waiting
+        for one to be released otherwise.
+    """
+    try:
+      return self.idle_clients.get_nowait()
+    except Empty:
+      pass
+
+    with self.lock:
+      can_create = self.created < self.size
+      if can_create:
+        self.created += 1
+
+    if can_create:
+      return docker.Client(version='auto', timeout=DEFAULT_DOCKER_TIMEOUT)
+
+    return self.idle_clients.get()
+
+  def release(self, client):
+    """ Returns a client to the pool. """
+    self.idle_clients.put(client)
+
+  def call(self, operation, *args, **kwargs):
+    """ Calls the given Docker API operation on a client from the pool. """
+    timeout = self.getTimeout(operation)
+    start = time.time()
+    failed = True
+    try:
+      if operation in STREAMING_OPERATIONS:
+        client = docker.Client(version='auto', timeout=timeout)
+        result = getattr(client, operation)(*args, **kwargs)
+      else:
+        client = self.acquire()
+        try:
+          client.timeout = timeout
+          result = getattr(client, operation)(*args, **kwargs)
+        finally:
+          self.release(client)
+
+      failed = False
+      return result
+    finally:
+      self.record(operation, time.time() - start, failed)
+
+  def record(self, operation, duration, failed):
+    """ Records the statistics of a call to the given operation. """
+    with self.lock:
+      if not operation in self.stats:
+        self.stats[operation] = DockerCallStats()
+
+      self.stats[operation].record(duration, failed)
+
+
+class PooledDockerClient(object):
+  """ A thread-safe stand-in for a docker client, which runs each API call on a client from
+      the given pool.
+  """
+  def __init__(self, pool):
+    self.pool = pool
+
+  def __getattr__(self, operation):
+    if operation.startswith('_'):
+      raise AttributeError(operation)
+
+    return partial(self.pool.call, operation)
@@ -43,9 +43,8 @@ def monitor(component):
     # Conduct the checks.
     report('Checking in on component ' + component.getName())
     if not component.isHealthy():
-      report('Component ' + component.getName() + ' is not healthy. Killing and restarting')
-      component.stop(kill=True)
-      if not component.update():
+      report('Component ' + component.getName() + ' is not healthy. Restarting')
+      if not component.repair(kill=True):
         report('Could not restart component ' + component.getName())
         return
 
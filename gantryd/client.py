@@ -3,11 +3,13 @@ from config.GantryConfig import Configuration
 from config.object import ConfigParseException
 
 from gantryd.componentwatcher import ComponentWatcher
+from gantryd.startup import StartupPlanner
 from gantryd.machinestate import MachineState
 from gantryd.componentstate import ComponentState, STOPPED_STATUS, KILLED_STATUS
 from gantryd.etcdpaths import getProjectConfigPath
 
-from util import report, fail, ReportLevels
+from runtime.metadata import getWriteQueueDepth
+from util import report, fail, getDockerCallStats, ReportLevels
 
 import etcd
 import uuid
@@ -19,6 +21,7 @@ import json
 import logging
 
 REPORT_TTL = 60 # Report that this machine is running, every 60 seconds
+METADATA_GC_INTERVAL = 300 # Collect the metadata of removed containers every 5 minutes
 
 class GantryDClient(object):
   """ A client in gantryd. """
@@ -41,6 +44,10 @@ class GantryDClient(object):
     self.reporting_thread = threading.Thread(target=self.reportMachineStatus, args=[])
     self.reporting_thread.daemon = True
 
+    # Initialize the thread used to remove the metadata of containers which no longer exist.
+    self.metadata_gc_thread = threading.Thread(target=self.collectMetadata, args=[])
+    self.metadata_gc_thread.daemon = True
+
   def getConfigJSON(self):
     """ Returns the project's config JSON or raises an exception if none. """
     # Lookup the project on etcd. If none, report an error.
@@ -135,11 +142,22 @@ class GantryDClient(object):
     # Start the thread to register this machine as being part of the project.
     self.startReporter()
 
-    # Start watcher thread(s), one for each component, to see when to update them.
+    # Start the thread to collect the metadata of removed containers.
+    self.metadata_gc_thread.start()
+
+    # Plan the startup order of the components, based on their component links.
+    planner = StartupPlanner(self.runtime_manager, self.components)
+    for index, layer in enumerate(planner.getLayers()):
+      report('Startup layer %s: %s' % (index, ', '.join(layer)), project=self.project_name,
+             level=ReportLevels.EXTRA)
+
+    # Start watcher thread(s), one for each component, to see when to update them. Components
+    # whose linked components are not yet running wait for them before starting.
     report('Gantryd running', project=self.project_name)
     for component in self.components:
       self.logger.debug('Starting component watcher for component: %s', component.getName())
-      watcher = ComponentWatcher(component, self.project_name, self.machine_id, self.etcd_client)
+      watcher = ComponentWatcher(component, self.project_name, self.machine_id, self.etcd_client,
+                                 planner)
       watcher.start()
 
     # And sleep until new stuff comes in.
@@ -155,7 +173,7 @@ class GantryDClient(object):
     self.getConfig()
 
     # Initialize the runtime manager.
-    self.runtime_manager = RuntimeManager(self.config)
+    self.runtime_manager = RuntimeManager(self.config, self.project_name, in_daemon=True)
 
     # Find all the components for this machine.
     for component_name in component_names:
@@ -193,7 +211,22 @@ class GantryDClient(object):
       machine_state = MachineState(self.project_name, self.machine_id, self.etcd_client)
       machine_state.registerMachine([c.getName() for c in self.components], ttl=REPORT_TTL)
 
+      # Log the Docker API call statistics.
+      for operation, stats in sorted(getDockerCallStats().items()):
+        self.logger.debug('Docker %s: %s calls, %s errors, %.3fs avg, %.3fs max', operation,
+                          stats.count, stats.errors, stats.getAverageTime(), stats.max_time)
+
+      self.logger.debug('Metadata writes queued: %s', getWriteQueueDepth())
+
       # Sleep for the TTL minus a few seconds.
       time.sleep(REPORT_TTL - 5)
 
+  def collectMetadata(self):
+    """ Periodically removes the metadata of containers which no longer exist. """
+    while self.is_running:
+      try:
+        self.runtime_manager.collectMetadata()
+      except Exception as e:
+        self.logger.exception(e)
 
+      time.sleep(METADATA_GC_INTERVAL)
@@ -2,13 +2,26 @@ import time
 import threading
 import json
 import logging
+import docker
 
 from gantryd.componentstate import ComponentState, STOPPED_STATUS, KILLED_STATUS, READY_STATUS, PULL_FAIL
+from runtime.events import CONTAINER_EVENT
+from runtime.metadata import getContainerStatus, getContainerComponent
+from containerutil import LABEL_COMPONENT
 from util import report, fail, getDockerClient, ReportLevels
 
 CHECK_SLEEP_TIME = 30 # 30 seconds
 CHECK_SHORT_SLEEP_TIME = 10 # 10 seconds
 MONITOR_SLEEP_TIME = 30 # 30 seconds
+PROVIDER_WAIT_TIME = 30 # 30 seconds
+
+# The Docker container events which indicate that a container has died. 'kill' is sent for any
+# signal (e.g. a SIGHUP to reload) and 'oom' may be for a child process, so neither means that the
+# container has stopped; a container which does stop always sends 'die'.
+CRASH_ACTIONS = set(['die'])
+
+# The container statuses under which a container is expected to be alive.
+LIVE_STATUSES = set(['starting', 'running'])
 
 class ComponentWatcher(object):
   """ Helper class which watches a specific component's status in etcd and
@@ -16,12 +29,15 @@ class ComponentWatcher(object):
       component itself once started, and ensures that it remains running (restarting
       it if it failed).
   """
-  def __init__(self, component, project_name, machine_id, etcd_client):
+  def __init__(self, component, project_name, machine_id, etcd_client, planner=None):
     self.component = component
     self.project_name = project_name
     self.machine_id = machine_id
     self.is_running = False
 
+    # The startup planner for the components on this machine, if any.
+    self.planner = planner
+
     # Logging.
     self.logger = logging.getLogger(__name__)
 
@@ -40,50 +56,101 @@ class ComponentWatcher(object):
     # on the component.
     self.monitor_event = threading.Event()
 
+    # Setup an event to wake the monitor thread immediately when a container of the
+    # component dies.
+    self.crash_event = threading.Event()
+    component.manager.events.addListener(self.handleDockerEvent)
+
     # Setup a lock to prevent multiple threads from trying to (re)start a container.
     self.update_lock = threading.Lock()
 
+    # Setup an event to wake the watcher thread before its sleep is over (e.g. when an
+    # image pull completes).
+    self.wake_event = threading.Event()
+
+    # The ID of the image with which the component was last deployed on this machine.
+    self.deployed_imageid = None
+
+    # The thread pulling the component's image in the background, if any, and the IDs of
+    # the last image pulled successfully and unsuccessfully by it.
+    self.pull_thread = None
+    self.prepulled_imageid = None
+    self.failed_pull_imageid = None
+
   def start(self):
     """ Starts the watcher. """
     self.watcher_thread.start()
     self.monitor_thread.start()
 
+  def handleDockerEvent(self, event):
+    """ Handles an event from the Docker events stream, waking the monitor thread if a live
+        container of the component has died.
+    """
+    if event.kind != CONTAINER_EVENT or not event.action in CRASH_ACTIONS:
+      return
+
+    if not self.is_running:
+      return
+
+    # Containers being drained, shut down or killed by gantry are not considered crashed.
+    if not getContainerStatus(event.id) in LIVE_STATUSES:
+      return
+
+    # Events from current Docker versions carry the container's labels.
+    component_name = event.attributes.get(LABEL_COMPONENT) or getContainerComponent(event.id)
+    if component_name != self.component.getName():
+      return
+
+    self.logger.debug('Container %s of component %s received event %s', event.id[:12],
+                      self.component.getName(), event.action)
+    self.crash_event.set()
+
   def monitorComponent(self):
-    """ Monitors a component by pinging it every MONITOR_SLEEP_TIME seconds or so. If a component
-        fails, then the system will try to restart it. If that fails, the component is marked
-        as dead.
+    """ Monitors a component by pinging it every MONITOR_SLEEP_TIME seconds or so, or right
+        away if one of its containers dies. If a component fails, then the system will try to
+        restart it. If that fails, the component is marked as dead.
     """
     while True:
       # Wait for the component to be running.
       self.monitor_event.wait()
 
-      # Sleep MONITOR_SLEEP_TIME seconds.
-      time.sleep(MONITOR_SLEEP_TIME)
+      # Sleep MONITOR_SLEEP_TIME seconds or until a container of the component dies.
+      self.crash_event.wait(MONITOR_SLEEP_TIME)
+      crashed = self.crash_event.is_set()
+      self.crash_event.clear()
 
-      # Check the component.
-      report('Checking in on component', project=self.project_name, component=self.component,
-             level=ReportLevels.BACKGROUND)
+      if crashed:
+        report('Container for component died', project=self.project_name,
+               component=self.component, level=ReportLevels.IMPORTANT)
+      else:
+        report('Checking in on component', project=self.project_name, component=self.component,
+               level=ReportLevels.BACKGROUND)
 
-      if not self.component.isHealthy():
-        self.logger.debug('Component %s is not healty', self.component.getName())
-        with self.update_lock:
-          # Just to be sure...
-          if not self.is_running:
-            continue
+      # Check the component, even after a crash event, so a component whose containers are all
+      # still running is left alone.
+      if self.component.isHealthy():
+        continue
 
-          # Ensure that the component is still ready.
-          state = self.state.getState()
-          current_status = ComponentState.getStatusOf(state)
-          if current_status == READY_STATUS:
-            report('Component ' + self.component.getName() + ' is not healthy. Restarting...',
-                   project=self.project_name, component=self.component)
+      self.logger.debug('Component %s is not healty', self.component.getName())
 
-            if not self.component.update():
-              report('Could not restart component ' + self.component.getName(),
-                     project=self.project_name, component=self.component,
-                     level=ReportLevels.IMPORTANT)
-              self.monitor_event.clear()
-              continue
+      with self.update_lock:
+        # Just to be sure...
+        if not self.is_running:
+          continue
+
+        # Ensure that the component is still ready.
+        state = self.state.getState()
+        current_status = ComponentState.getStatusOf(state)
+        if current_status == READY_STATUS:
+          report('Component ' + self.component.getName() + ' is not healthy. Restarting...',
+                 project=self.project_name, component=self.component)
+
+          if not self.component.repair():
+            report('Could not restart component ' + self.component.getName(),
+                   project=self.project_name, component=self.component,
+                   level=ReportLevels.IMPORTANT)
+            self.monitor_event.clear()
+            continue
 
   def waitForCommand(self):
     """ Waits for an command notification on the component in etcd. If one is received,
@@ -92,8 +159,9 @@ class ComponentWatcher(object):
     is_initial_loop = True
     sleep_time = 0
     while True:
-      # Sleep and then check again.
-      time.sleep(sleep_time)
+      # Sleep (or wait to be woken) and then check again.
+      self.wake_event.wait(sleep_time)
+      self.wake_event.clear()
       sleep_time = CHECK_SLEEP_TIME
 
       # Check the component's status.
@@ -133,6 +201,7 @@ class ComponentWatcher(object):
              project=self.project_name, component=self.component)
 
     self.is_running = False
+    self.markNotReady()
     self.component.stop(kill=False)
     return CHECK_SLEEP_TIME
 
@@ -145,6 +214,7 @@ class ComponentWatcher(object):
              project=self.project_name, component=self.component)
 
     self.is_running = False
+    self.markNotReady()
     self.component.stop(kill=True)
     return CHECK_SLEEP_TIME
 
@@ -155,16 +225,12 @@ class ComponentWatcher(object):
     #   - The ID of the component's image does not match that found in the status.
     #   - The process is not running.
     imageid = ComponentState.getImageIdOf(state)
-    imageid_different = imageid != self.component.getImageId()
+    local_imageid = self.getLocalImageId()
+    current_imageid = self.deployed_imageid if self.is_running else local_imageid
+    imageid_different = imageid != current_imageid
     should_update = not self.is_running or imageid_different
 
     if should_update:
-      self.is_running = False
-      self.monitor_event.clear()
-
-      # We need to update this machine's copy. First, do a test and set to ensure that
-      # we are the only machine allowed to update. If the test and set fails, we'll
-      # try again in 10s.
       if imageid_different:
         report('Detected pushed update for component ' + self.component.getName(),
                project=self.project_name, component=self.component)
@@ -172,6 +238,26 @@ class ComponentWatcher(object):
         report('Component %s is not running; starting' % self.component.getName(),
                project=self.project_name, component=self.component)
 
+      # Make sure the image is present locally before competing for the update lock, so
+      # that the locked window only covers starting the component. The pull runs in the
+      # background and wakes the watcher when done.
+      if imageid_different and local_imageid != imageid and self.prepulled_imageid != imageid:
+        return self.prePullImage(imageid, state)
+
+      # On startup, wait for the components providing the links required by this component
+      # to be running, so that it starts as soon as they are.
+      if not self.is_running and self.planner is not None:
+        if not self.planner.waitForProviders(self.component, PROVIDER_WAIT_TIME):
+          report('Waiting for linked components to start',
+                 project=self.project_name, component=self.component)
+          return CHECK_SHORT_SLEEP_TIME
+
+      self.is_running = False
+      self.monitor_event.clear()
+
+      # We need to update this machine's copy. First, do a test and set to ensure that
+      # we are the only machine allowed to update. If the test and set fails, we'll
+      # try again in 10s.
       result = self.state.setUpdatingStatus('updating', self.machine_id, state)
       if not result:
         # The exchange failed. Sleep CHECK_SHORT_SLEEP_TIME seconds and try again.
@@ -179,17 +265,6 @@ class ComponentWatcher(object):
                project=self.project_name, component=self.component)
         return CHECK_SHORT_SLEEP_TIME
 
-      # Start the update by pulling the repo for the component.
-      if imageid_different:
-        report('Pulling the image for component ' + self.component.getName())
-        if not self.component.pullRepo():
-          # The pull failed.
-          report('Pull failed of image %s for component %s' % (imageid[0:12],
-                                                               self.component.getName()),
-                 project=self.project_name, component=self.component, level=ReportLevels.IMPORTANT)
-          self.state.setUpdatingStatus('pullfail', self.machine_id, result)
-          return CHECK_SLEEP_TIME
-
       # Run the update on the component and wait for it to finish.
       if imageid_different:
         report('Starting update for component ' + self.component.getName(),
@@ -197,6 +272,7 @@ class ComponentWatcher(object):
 
       if not self.component.update():
         # The update failed.
+        self.markNotReady()
         self.state.setUpdatingStatus('updatefail', self.machine_id, result)
         return CHECK_SLEEP_TIME
 
@@ -209,8 +285,59 @@ class ComponentWatcher(object):
         report('Component ' + self.component.getName() + ' is now running',
                project=self.project_name, component=self.component)
 
-      self.state.setReadyStatus(self.component.getImageId())
+      self.deployed_imageid = self.component.getImageId()
+      self.prepulled_imageid = None
+      self.state.setReadyStatus(self.deployed_imageid)
       self.is_running = True
       self.monitor_event.set()
+      if self.planner is not None:
+        self.planner.markReady(self.component)
 
     return CHECK_SLEEP_TIME
+
+  def markNotReady(self):
+    """ Marks the component as no longer running in the startup planner, if any. """
+    if self.planner is not None:
+      self.planner.markNotReady(self.component)
+
+  def prePullImage(self, imageid, state):
+    """ Starts pulling the image for the component in the background (if not already doing
+        so) and returns the amount of time after which to check the state again. If the
+        previous pull of this image failed, marks the component as having failed to pull.
+    """
+    if self.pull_thread is not None and self.pull_thread.isAlive():
+      return CHECK_SLEEP_TIME
+
+    if self.failed_pull_imageid == imageid:
+      # The pull failed.
+      self.failed_pull_imageid = None
+      report('Pull failed of image %s for component %s' % (imageid[0:12],
+                                                           self.component.getName()),
+             project=self.project_name, component=self.component, level=ReportLevels.IMPORTANT)
+      self.state.setUpdatingStatus(PULL_FAIL, self.machine_id, state)
+      return CHECK_SLEEP_TIME
+
+    report('Pulling the image for component ' + self.component.getName(),
+           project=self.project_name, component=self.component)
+    self.pull_thread = threading.Thread(target=self.pullImage, args=[imageid])
+    self.pull_thread.daemon = True
+    self.pull_thread.start()
+    return CHECK_SLEEP_TIME
+
+  def pullImage(self, imageid):
+    """ Pulls the image for the component, waking the watcher thread once done. """
+    if self.component.pullRepo():
+      report('Pulled the image for component ' + self.component.getName(),
+             project=self.project_name, component=self.component)
+      self.prepulled_imageid = imageid
+    else:
+      self.failed_pull_imageid = imageid
+
+    self.wake_event.set()
+
+  def getLocalImageId(self):
+    """ Returns the ID of the component's image present locally or None if none. """
+    try:
+      return self.component.getImageId()
+    except docker.errors.NotFound:
+      return None
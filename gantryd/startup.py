@@ -0,0 +1,93 @@
+import threading
+import logging
+
+from util import fail
+
+class StartupPlanner(object):
+  """ Helper class which orders the startup of the components run by this machine, based on
+      the component links they require and define. Components with no (local) providers can
+      start right away and in parallel; the others wait until all of their providers are
+      running.
+  """
+  def __init__(self, runtime_manager, components):
+    # Logging.
+    self.logger = logging.getLogger(__name__)
+
+    # The components run by this machine, by name.
+    self.components = {component.getName(): component for component in components}
+
+    # The names of the components (run by this machine) providing the links required by
+    # each component.
+    self.providers = {}
+    for component in components:
+      providers = set()
+      for link_name in component.config.getComponentLinks().values():
+        provider = runtime_manager.lookupComponentLinkProvider(link_name)
+        if provider and provider.getName() in self.components and provider != component:
+          providers.add(provider.getName())
+
+      self.providers[component.getName()] = providers
+
+    # The events set when each component is running.
+    self.ready_events = {name: threading.Event() for name in self.components}
+
+    # The startup layers of the components: each layer only depends on the previous ones.
+    self.layers = self.buildLayers()
+
+  def buildLayers(self):
+    """ Returns the list of startup layers (lists of component names), failing if the component
+        links form a cycle.
+    """
+    layers = []
+    placed = set()
+    remaining = set(self.components.keys())
+    while remaining:
+      layer = sorted([name for name in remaining if self.providers[name] <= placed])
+      if not layer:
+        fail('Cyclic component links found between components: ' + ', '.join(sorted(remaining)))
+
+      layers.append(layer)
+      placed.update(layer)
+      remaining.difference_update(layer)
+
+    return layers
+
+  def getLayers(self):
+    """ Returns the list of startup layers (lists of component names). """
+    return self.layers
+
+  def getProviders(self, component):
+    """ Returns the components (run by this machine) providing the links required by the given
+        component.
+    """
+    return [self.components[name] for name in self.providers.get(component.getName(), [])]
+
+  def waitForProviders(self, component, timeout):
+    """ Waits up to the given timeout for all the providers of the given component to be
+        running. Returns whether they are all running.
+    """
+    for provider in self.getProviders(component):
+      ready_event = self.ready_events[provider.getName()]
+      if ready_event.is_set():
+        continue
+
+      # The provider may already be running, e.g. from a previous run of gantryd.
+      if provider.getPrimaryContainer() is not None:
+        continue
+
+      self.logger.debug('Component %s waiting for provider %s', component.getName(),
+                        provider.getName())
+      if not ready_event.wait(timeout):
+        return False
+
+    return True
+
+  def markReady(self, component):
+    """ Marks the given component as running, releasing the components that depend on it. """
+    if component.getName() in self.ready_events:
+      self.ready_events[component.getName()].set()
+
+  def markNotReady(self, component):
+    """ Marks the given component as no longer running. """
+    if component.getName() in self.ready_events:
+      self.ready_events[component.getName()].clear()
@@ -1,6 +1,7 @@
 from functools import partial
 
 from networkcheck import TcpCheck, HttpRequestCheck, IncomingConnectionCheck
+from dockercheck import DockerHealthCheck
 from termination import HttpTerminationSignal, ExecTerminationSignal
 from util import report, fail, getDockerClient
 
@@ -10,6 +11,7 @@ HEALTH_CHECKS = {
   'http': partial(HttpRequestCheck, 'http'),
   'https': partial(HttpRequestCheck, 'https'),
   'connection': IncomingConnectionCheck,
+  'docker': DockerHealthCheck,
 }
 
 def buildHealthCheck(check_config):
@@ -0,0 +1,26 @@
+import containerutil
+
+from health.healthcheck import HealthCheck
+from util import ReportLevels, getDockerClient
+
+HEALTHY_STATUS = 'healthy'
+
+class DockerHealthCheck(HealthCheck):
+  """ A health check which uses the status of the HEALTHCHECK defined in the container's image.
+      If the image defines no HEALTHCHECK, the check succeeds once the container is running.
+  """
+  def __init__(self, config):
+    super(DockerHealthCheck, self).__init__()
+    self.config = config
+
+  def run(self, container, report):
+    container_info = containerutil.inspectContainer(getDockerClient(), container)
+    state = container_info['State']
+    health = state.get('Health')
+    if not health:
+      return bool(state.get('Running'))
+
+    status = health.get('Status')
+    report('Docker health status of container ' + container['Id'][0:12] + ': ' + str(status),
+      level = ReportLevels.EXTRA)
+    return status == HEALTHY_STATUS
@@ -3,7 +3,7 @@ import urllib2
 
 from health.healthcheck import HealthCheck
 from util import ReportLevels
-from proxy.portproxy import Proxy
+from proxy.proxies import getContainerConnectionCount
 
 class TcpCheck(HealthCheck):
   """ A health check which tries to connect to a port via TCP. """
@@ -19,6 +19,7 @@ class TcpCheck(HealthCheck):
       level = ReportLevels.EXTRA)
     try:
       sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      sock.settimeout(2)
       sock.connect((container_ip, container_port))
       sock.close()
     except Exception as e:
@@ -65,14 +66,11 @@ class IncomingConnectionCheck(HealthCheck):
   def run(self, container, report):
     container_ip = self.getContainerIPAddress(container)
 
-    for connection in Proxy.get_connections():
-      if not connection.laddr or not connection.raddr:
-        continue
-
-      if connection.raddr[0] == container_ip:
-        report('Container still has existing connections: %s' % container['Id'][0:12],
-               level=ReportLevels.EXTRA)
-        return False
+    count = getContainerConnectionCount(container_ip)
+    if count > 0:
+      report('Container still has %s existing connection(s): %s' % (count, container['Id'][0:12]),
+             level=ReportLevels.EXTRA)
+      return False
 
     report('Container has no remaining connections: %s' % container['Id'][0:12],
            level=ReportLevels.EXTRA)
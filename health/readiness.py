@@ -0,0 +1,74 @@
+import threading
+import time
+import logging
+
+from util import ReportLevels
+
+INITIAL_POLL_INTERVAL = 0.05 # 50 milliseconds
+BACKOFF_FACTOR = 2
+
+class ReadyCheckEngine(object):
+  """ Runs the ready checks of a component against a container until they all pass, the
+      deadline is reached or the engine is cancelled. A failing check is retried after
+      INITIAL_POLL_INTERVAL seconds, backing off exponentially up to the check's timeout.
+  """
+  def __init__(self, checks, container, timeout, report):
+    # Logging.
+    self.logger = logging.getLogger(__name__)
+
+    # The (config, check) pairs to run, in order.
+    self.checks = checks
+
+    # The container being checked.
+    self.container = container
+
+    # The maximum amount of time, in seconds, the checks may take in total.
+    self.timeout = timeout
+
+    # The function used to report progress.
+    self.report = report
+
+    # Set when the engine is cancelled.
+    self.cancelled = threading.Event()
+
+    # Set to retry the current check right away (e.g. when the container's health changed).
+    self.woken = threading.Event()
+
+  def getContainerId(self):
+    """ Returns the ID of the container being checked. """
+    return self.container['Id']
+
+  def cancel(self):
+    """ Cancels the checks. run() will return False as soon as possible. """
+    self.cancelled.set()
+    self.woken.set()
+
+  def wake(self):
+    """ Retries the failing check right away, instead of waiting for its next poll. """
+    self.woken.set()
+
+  def run(self):
+    """ Runs the checks, returning whether they all passed before the deadline. """
+    deadline = time.time() + self.timeout
+    for (config, check) in self.checks:
+      interval = INITIAL_POLL_INTERVAL
+      while True:
+        if self.cancelled.is_set():
+          self.logger.debug('Ready checks cancelled')
+          return False
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          self.logger.debug('Ready checks have timed out')
+          return False
+
+        self.report('Running health check: ' + config.getTitle(), level=ReportLevels.EXTRA)
+        if check.run(self.container, self.report):
+          break
+
+        # Wait until the next poll, the deadline or until woken.
+        self.woken.wait(min(interval, config.timeout, remaining))
+        self.woken.clear()
+        interval = interval * BACKOFF_FACTOR
+
+    return not self.cancelled.is_set()
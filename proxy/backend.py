@@ -0,0 +1,39 @@
+class ProxyBackend(object):
+  """ Interface of the proxies routing the external ports of the host to the containers. Routes
+      are registered with clear_routes and add_route, and only take effect on commit.
+  """
+  def __init__(self):
+    # The registered routes, by external port number.
+    self._port_routes = {}
+
+  def clear_routes(self):
+    """ Clears all routes found in the proxy. """
+    self._port_routes = {}
+
+  def add_route(self, route):
+    """ Adds a route to the proxy (but does not commit the changes). If a route already exists
+        for the same host port, the servers of the given route are added to it, and traffic is
+        balanced across all of them.
+    """
+    existing = self._port_routes.get(route.host_port)
+    if existing is not None and not existing.is_fake:
+      existing.servers.extend(route.servers)
+      return
+
+    self._port_routes[route.host_port] = route
+
+  def commit(self):
+    """ Commits the changes made to the proxy. """
+    raise NotImplementedError
+
+  def shutdown(self):
+    """ Shuts down the proxy entirely. """
+    raise NotImplementedError
+
+  def get_connection_counts(self):
+    """ Returns the number of connections the proxy holds, by container IP address. """
+    raise NotImplementedError
+
+  def get_container_connection_count(self, container_ip):
+    """ Returns the number of connections the proxy holds to the given container. """
+    return self.get_connection_counts().get(container_ip, 0)
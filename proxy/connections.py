@@ -0,0 +1,91 @@
+import socket
+import struct
+import threading
+import time
+import logging
+
+from collections import defaultdict
+
+TCP_TABLES = ['/proc/net/tcp', '/proc/net/tcp6']
+SAMPLE_TTL = 1 # 1 second
+
+# The TCP states (as found in /proc/net/tcp) of sockets which no longer carry a connection.
+TCP_TIME_WAIT = '06'
+TCP_CLOSE = '07'
+TCP_CLOSE_WAIT = '08'
+TCP_LISTEN = '0A'
+INACTIVE_TCP_STATES = set([TCP_TIME_WAIT, TCP_CLOSE, TCP_CLOSE_WAIT, TCP_LISTEN])
+
+IPV4_MAPPED_PREFIX = '::ffff:'
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_tcp_address(hex_address):
+  """ Returns the IP address of the given /proc/net/tcp(6) address (e.g. '0100007F:1F90'). The
+      address is made of 32-bit words in host (little-endian) order.
+  """
+  hex_ip = hex_address.split(':')[0]
+  if len(hex_ip) == 8:
+    return socket.inet_ntoa(struct.pack('<I', int(hex_ip, 16)))
+
+  packed = ''.join([struct.pack('<I', int(hex_ip[index:index + 8], 16))
+                    for index in range(0, 32, 8)])
+  address = socket.inet_ntop(socket.AF_INET6, packed)
+  if address.startswith(IPV4_MAPPED_PREFIX) and '.' in address:
+    return address[len(IPV4_MAPPED_PREFIX):]
+
+  return address
+
+
+def read_tcp_connection_counts(tables=TCP_TABLES):
+  """ Returns the number of active TCP connections on this host, by remote IP address. """
+  counts = defaultdict(int)
+  for table in tables:
+    try:
+      with open(table) as table_file:
+        lines = table_file.readlines()[1:]
+    except IOError:
+      continue
+
+    for line in lines:
+      fields = line.split()
+      if len(fields) < 4 or fields[3] in INACTIVE_TCP_STATES:
+        continue
+
+      counts[parse_tcp_address(fields[2])] += 1
+
+  return dict(counts)
+
+
+class ConnectionSampler(object):
+  """ Samples the connection counts of the host at most once every TTL seconds, sharing each
+      sample between all the threads asking for counts, so the cost of polling stays the same
+      however many containers are being drained.
+  """
+  def __init__(self, source, ttl=SAMPLE_TTL):
+    # The function returning a dict of connection counts, by container IP address.
+    self.source = source
+
+    # How long, in seconds, a sample is used for.
+    self.ttl = ttl
+
+    # The current sample and when it was taken.
+    self.counts = None
+    self.sampled_at = 0
+
+    self.lock = threading.Lock()
+
+  def get_connection_counts(self):
+    """ Returns the connection counts, by container IP address, sampling them if needed. """
+    with self.lock:
+      if self.counts is None or time.time() - self.sampled_at >= self.ttl:
+        self.counts = self.source()
+        self.sampled_at = time.time()
+
+      return self.counts
+
+  def get_connection_count(self, container_ip):
+    """ Returns the number of connections to the given container IP address. """
+    return self.get_connection_counts().get(container_ip, 0)
@@ -0,0 +1,579 @@
+import errno
+import os
+import select
+import socket
+import threading
+import time
+import logging
+
+from collections import defaultdict
+
+from backend import ProxyBackend
+
+BUFFER_SIZE = 65536
+LISTEN_BACKLOG = 128
+CONNECT_TIMEOUT = 5 # 5 seconds
+POLL_TIMEOUT = 1 # 1 second
+ACCEPT_PAUSE = 1 # 1 second
+
+# The poll event flags (the same for poll and epoll).
+EVENT_READ = select.POLLIN
+EVENT_WRITE = select.POLLOUT
+EVENT_FAILED = select.POLLERR
+EVENT_HANGUP = select.POLLHUP
+EVENT_ERROR = EVENT_FAILED | EVENT_HANGUP
+
+# The socket errors meaning the operation should be retried later.
+RETRY_ERRNOS = set([errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR])
+CONNECT_ERRNOS = set([errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK])
+
+
+logger = logging.getLogger(__name__)
+
+
+class Poller(object):
+  """ Thin wrapper around epoll (or poll, where epoll is not available). """
+  def __init__(self):
+    if hasattr(select, 'epoll'):
+      self.poller = select.epoll()
+      self.timeout_scale = 1
+    else:
+      self.poller = select.poll()
+      self.timeout_scale = 1000
+
+    self.registered = set()
+
+  def update(self, fd, events):
+    """ Registers the given file descriptor for the given events, or modifies its events. """
+    if fd in self.registered:
+      self.poller.modify(fd, events)
+    else:
+      self.poller.register(fd, events)
+      self.registered.add(fd)
+
+  def unregister(self, fd):
+    """ Unregisters the given file descriptor. """
+    if fd in self.registered:
+      self.registered.discard(fd)
+      self.poller.unregister(fd)
+
+  def poll(self, timeout):
+    """ Waits up to the given timeout, in seconds, for events. Returns (fd, events) pairs. """
+    try:
+      return self.poller.poll(timeout * self.timeout_scale)
+    except (IOError, select.error) as e:
+      if e.args[0] == errno.EINTR:
+        return []
+
+      raise
+
+
+class RouteStats(object):
+  """ Traffic statistics of a single route (external port). """
+  def __init__(self):
+    self.connections = 0
+    self.active = 0
+    self.failed = 0
+    self.bytes_in = 0
+    self.bytes_out = 0
+    self.connect_time_total = 0.0
+    self.connect_time_max = 0.0
+    self.started_at = time.time()
+
+  def record_connect(self, duration):
+    """ Records a connection to a server established in the given time, in seconds. """
+    self.connect_time_total += duration
+    self.connect_time_max = max(self.connect_time_max, duration)
+
+  def get_average_connect_time(self):
+    """ Returns the average time, in seconds, taken to connect to a server. """
+    connected = self.connections - self.failed
+    return self.connect_time_total / connected if connected > 0 else 0.0
+
+  def copy(self):
+    """ Returns a copy of the statistics. """
+    copied = RouteStats()
+    copied.__dict__.update(self.__dict__)
+    return copied
+
+  def get_throughput(self):
+    """ Returns the average throughput of the route, in bytes per second (both directions). """
+    elapsed = time.time() - self.started_at
+    return (self.bytes_in + self.bytes_out) / elapsed if elapsed > 0 else 0.0
+
+
+class EngineRoute(object):
+  """ A committed route of the engine: the servers of an external port, chosen in proportion to
+      their weights (smooth weighted round robin). A server added with slow start enabled ramps
+      up from a weight of 1 to its full weight over the route's slow start time.
+  """
+  def __init__(self, route, stats, previous=None):
+    self.host_port = route.host_port
+    self.servers = [(server.get_address(), server.weight) for server in route.servers]
+    self.slow_start = route.slow_start
+    self.stats = stats
+
+    # When each server was added to the route, kept across commits.
+    now = time.time()
+    added_at = previous.added_at if previous is not None else {}
+    self.added_at = {address: added_at.get(address, now) for (address, _) in self.servers}
+
+    # The current (smooth round robin) weight of each server.
+    self.current_weights = defaultdict(int)
+
+  def get_effective_weight(self, address, weight, now):
+    """ Returns the weight of the given server, taking slow start into account. """
+    if weight <= 0 or self.slow_start <= 0:
+      return max(0, weight)
+
+    ramp = (now - self.added_at[address]) / float(self.slow_start)
+    return max(1, min(weight, int(weight * ramp)))
+
+  def choose_server(self):
+    """ Returns the (address, port) of the next server or None if no server has any weight. """
+    now = time.time()
+    total = 0
+    chosen = None
+    for (address, weight) in self.servers:
+      weight = self.get_effective_weight(address, weight, now)
+      if weight <= 0:
+        continue
+
+      self.current_weights[address] += weight
+      total += weight
+      if chosen is None or self.current_weights[address] > self.current_weights[chosen]:
+        chosen = address
+
+    if chosen is not None:
+      self.current_weights[chosen] -= total
+
+    return chosen
+
+
+class Listener(object):
+  """ A listening socket accepting the connections of an external port. """
+  def __init__(self, engine, port):
+    self.engine = engine
+    self.port = port
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.sock.bind(('0.0.0.0', port))
+    self.sock.listen(LISTEN_BACKLOG)
+    self.sock.setblocking(0)
+
+    # When accepting was paused after an error (e.g. out of file descriptors), the time at which
+    # to resume it.
+    self.paused_until = None
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def handle(self, fd, events):
+    while True:
+      try:
+        client, _ = self.sock.accept()
+      except socket.error as e:
+        if e.args[0] in RETRY_ERRNOS:
+          return
+
+        # The pending connection stays queued, so polling again would fail straight away: stop
+        # polling the listener for a while instead.
+        self.pause(e)
+        return
+
+      try:
+        self.engine.open_connection(self.port, client)
+      except socket.error as e:
+        client.close()
+        self.pause(e)
+        return
+
+  def pause(self, error):
+    """ Stops accepting connections for a while, after the given error. """
+    logger.warning('Pausing accepting connections on port %s: %s', self.port, error)
+    self.paused_until = time.time() + ACCEPT_PAUSE
+    self.engine.poller.unregister(self.fileno())
+
+  def resume(self, now):
+    """ Resumes accepting connections, if paused and the pause is over. """
+    if self.paused_until is not None and now >= self.paused_until:
+      self.paused_until = None
+      self.engine.poller.update(self.fileno(), EVENT_READ)
+
+  def close(self):
+    self.engine.poller.unregister(self.sock.fileno())
+    self.sock.close()
+
+
+class Connection(object):
+  """ A client connection proxied to a server. Data is read from a side only once everything
+      read before has been written to the other side.
+  """
+  def __init__(self, engine, route, server_address, client):
+    self.engine = engine
+    self.stats = route.stats
+    self.server_address = server_address
+
+    self.client = client
+    self.client.setblocking(0)
+    self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.server.setblocking(0)
+    self.server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # The data waiting to be written to each side.
+    self.to_server = ''
+    self.to_client = ''
+
+    # Whether each side has finished sending.
+    self.client_eof = False
+    self.server_eof = False
+
+    # The sockets whose peer has hung up. Nothing more can be written to them, but the data
+    # they received can still be read.
+    self.hung_up = set()
+
+    self.connecting = True
+    self.connect_started = time.time()
+    self.closed = False
+
+  def start(self):
+    """ Starts connecting to the server. """
+    result = self.server.connect_ex(self.server_address)
+    if result != 0 and not result in CONNECT_ERRNOS:
+      self.fail('Could not connect to %s:%s: %s' % (self.server_address + (os.strerror(result),)))
+      return
+
+    self.update_events()
+
+  def handle(self, fd, events):
+    sock = self.server if fd == self.server.fileno() else self.client
+    if events & EVENT_HANGUP:
+      self.hung_up.add(sock)
+
+    try:
+      if sock is self.server:
+        self.handle_server(events)
+      else:
+        self.handle_client(events)
+    except socket.error as e:
+      if not e.args[0] in RETRY_ERRNOS:
+        self.close()
+        return
+
+    if self.closed:
+      return
+
+    # A failed side (e.g. reset) ends the connection, as does a side which hung up while data
+    # is still waiting to be written to it.
+    if (events & EVENT_FAILED or (self.server in self.hung_up and self.to_server) or
+        (self.client in self.hung_up and self.to_client)):
+      self.close()
+      return
+
+    self.update_events()
+
+  def handle_server(self, events):
+    if self.connecting:
+      error = self.server.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if error:
+        self.fail('Could not connect to %s:%s: %s' % (self.server_address + (os.strerror(error),)))
+        return
+
+      self.connecting = False
+      self.stats.record_connect(time.time() - self.connect_started)
+
+    if events & EVENT_WRITE and self.to_server:
+      sent = self.server.send(self.to_server)
+      self.to_server = self.to_server[sent:]
+      self.stats.bytes_in += sent
+
+    if events & (EVENT_READ | EVENT_ERROR) and not self.to_client and not self.server_eof:
+      data = self.server.recv(BUFFER_SIZE)
+      if data:
+        self.to_client = data
+      else:
+        self.server_eof = True
+
+    self.flush()
+
+  def handle_client(self, events):
+    if events & EVENT_WRITE and self.to_client:
+      sent = self.client.send(self.to_client)
+      self.to_client = self.to_client[sent:]
+      self.stats.bytes_out += sent
+
+    if events & (EVENT_READ | EVENT_ERROR) and not self.to_server and not self.client_eof:
+      data = self.client.recv(BUFFER_SIZE)
+      if data:
+        self.to_server = data
+      else:
+        self.client_eof = True
+
+    self.flush()
+
+  def flush(self):
+    """ Propagates the end of the data of each side once its data has been written, closing the
+        connection once both sides are done.
+    """
+    if self.connecting:
+      return
+
+    if self.client_eof and not self.to_server:
+      self.shutdown_write(self.server)
+
+    if self.server_eof and not self.to_client:
+      self.shutdown_write(self.client)
+
+    if self.client_eof and self.server_eof and not self.to_server and not self.to_client:
+      self.close()
+      return
+
+    # A side which hung up takes no more data, so the connection is over once everything it
+    # sent has been written to the other side.
+    if ((self.server in self.hung_up and self.server_eof and not self.to_client) or
+        (self.client in self.hung_up and self.client_eof and not self.to_server)):
+      self.close()
+
+  def shutdown_write(self, sock):
+    try:
+      sock.shutdown(socket.SHUT_WR)
+    except socket.error:
+      pass
+
+  def update_events(self):
+    """ Registers the events the connection is waiting for on each side. """
+    server_events = EVENT_ERROR
+    client_events = EVENT_ERROR
+    if self.connecting:
+      server_events |= EVENT_WRITE
+    else:
+      if self.to_server:
+        server_events |= EVENT_WRITE
+      elif not self.client_eof:
+        client_events |= EVENT_READ
+
+      if self.to_client:
+        client_events |= EVENT_WRITE
+      elif not self.server_eof:
+        server_events |= EVENT_READ
+
+    # Hangups are reported whatever the events asked for, so a socket which hung up is only
+    # polled while there is something to read from it (once the other side has caught up).
+    for (sock, events) in [(self.server, server_events), (self.client, client_events)]:
+      if sock in self.hung_up and events == EVENT_ERROR:
+        self.engine.poller.unregister(sock.fileno())
+      else:
+        self.engine.poller.update(sock.fileno(), events)
+
+  def fail(self, message):
+    logger.debug(message)
+    self.stats.failed += 1
+    self.close()
+
+  def close(self):
+    if self.closed:
+      return
+
+    self.closed = True
+    self.engine.close_connection(self)
+    for sock in [self.client, self.server]:
+      self.engine.poller.unregister(sock.fileno())
+      sock.close()
+
+
+class ProxyEngine(ProxyBackend):
+  """ An in-process TCP proxy, as an alternative to HAProxy. All the connections are served by a
+      single thread polling non-blocking sockets. Committing swaps the route table atomically:
+      new connections use the new servers while existing connections run until they finish.
+      The engine counts the connections to each container exactly and keeps traffic statistics
+      for each route.
+  """
+  def __init__(self):
+    super(ProxyEngine, self).__init__()
+
+    self.poller = Poller()
+
+    # The committed routes, by external port number. Replaced (never modified) on commit.
+    self.routes = {}
+
+    # The statistics of each external port, kept across commits.
+    self.stats = {}
+
+    # The listeners, by external port number, and the handlers, by file descriptor. Only used
+    # on the engine thread.
+    self.listeners = {}
+    self.handlers = {}
+
+    # The listeners to add and close, handed over to the engine thread.
+    self.pending_listeners = []
+    self.closing_ports = []
+
+    # The open connections and the number of connections to each container IP address.
+    self.connections = set()
+    self.connection_counts = defaultdict(int)
+    self.lock = threading.Lock()
+
+    # The pipe used to wake up the engine thread.
+    (self.wake_read, self.wake_write) = os.pipe()
+    self.poller.update(self.wake_read, EVENT_READ)
+
+    # Whether the engine thread should keep running.
+    self.running = True
+
+    self.thread = threading.Thread(target=self.run, args=[])
+    self.thread.daemon = True
+    self.thread.start()
+
+  def commit(self):
+    """ Commits the changes made to the proxy, opening the listeners of new ports and closing
+        those of removed ports. If a port cannot be bound, nothing is changed and the error is
+        raised.
+    """
+    with self.lock:
+      routes = {}
+      for port, route in self._port_routes.items():
+        if route.is_fake or not route.servers:
+          continue
+
+        if not port in self.stats:
+          self.stats[port] = RouteStats()
+
+        routes[port] = EngineRoute(route, self.stats[port], self.routes.get(port))
+
+      # A port removed by a commit the engine thread has not applied yet still has its
+      # listener, which is kept.
+      added_ports = set(routes.keys()) - set(self.routes.keys())
+      reopened_ports = [port for port in added_ports if port in self.closing_ports]
+
+      listeners = []
+      try:
+        for port in added_ports - set(reopened_ports):
+          listeners.append(Listener(self, port))
+      except Exception:
+        for listener in listeners:
+          listener.close()
+
+        raise
+
+      for port in reopened_ports:
+        self.closing_ports.remove(port)
+
+      self.pending_listeners.extend(listeners)
+      self.closing_ports.extend(set(self.routes.keys()) - set(routes.keys()))
+      self.routes = routes
+
+    self.wake()
+
+  def shutdown(self):
+    """ Stops accepting connections on all ports. Existing connections run until they finish. """
+    self.clear_routes()
+    self.commit()
+
+  def stop(self):
+    """ Stops the engine thread, closing all the listeners and connections. """
+    self.running = False
+    self.wake()
+    self.thread.join()
+
+  def get_connection_counts(self):
+    with self.lock:
+      return dict(self.connection_counts)
+
+  def get_route_stats(self):
+    """ Returns a copy of the statistics of each route, by external port number. """
+    with self.lock:
+      return {port: stats.copy() for (port, stats) in self.stats.items()}
+
+  def wake(self):
+    os.write(self.wake_write, 'x')
+
+  def open_connection(self, port, client):
+    """ Proxies the given client connection, accepted on the given port. """
+    route = self.routes.get(port)
+    server_address = route.choose_server() if route is not None else None
+    if server_address is None:
+      client.close()
+      return
+
+    connection = Connection(self, route, server_address, client)
+    with self.lock:
+      self.connections.add(connection)
+      self.connection_counts[connection.server_address[0]] += 1
+      route.stats.connections += 1
+      route.stats.active += 1
+
+    self.handlers[connection.client.fileno()] = connection
+    self.handlers[connection.server.fileno()] = connection
+    connection.start()
+
+  def close_connection(self, connection):
+    """ Forgets the given (closing) connection. """
+    self.handlers.pop(connection.client.fileno(), None)
+    self.handlers.pop(connection.server.fileno(), None)
+    with self.lock:
+      self.connections.discard(connection)
+      address = connection.server_address[0]
+      self.connection_counts[address] -= 1
+      if self.connection_counts[address] <= 0:
+        del self.connection_counts[address]
+
+      connection.stats.active -= 1
+
+  def apply_listener_changes(self):
+    """ Registers the new listeners and closes the removed ones. """
+    os.read(self.wake_read, BUFFER_SIZE)
+    with self.lock:
+      added = self.pending_listeners
+      closing = self.closing_ports
+      self.pending_listeners = []
+      self.closing_ports = []
+
+    for listener in added:
+      self.listeners[listener.port] = listener
+      self.handlers[listener.fileno()] = listener
+      self.poller.update(listener.fileno(), EVENT_READ)
+
+    for port in closing:
+      listener = self.listeners.pop(port, None)
+      if listener is not None:
+        self.handlers.pop(listener.fileno(), None)
+        listener.close()
+
+  def resume_listeners(self):
+    """ Resumes accepting on the listeners whose pause is over. """
+    now = time.time()
+    for listener in self.listeners.values():
+      listener.resume(now)
+
+  def expire_connects(self):
+    """ Fails the connections which could not connect to their server in time. """
+    now = time.time()
+    for connection in list(self.connections):
+      if connection.connecting and now - connection.connect_started > CONNECT_TIMEOUT:
+        connection.fail('Timed out connecting to %s:%s' % connection.server_address)
+
+  def run(self):
+    """ Serves the connections until the engine is stopped. """
+    while self.running:
+      try:
+        for (fd, events) in self.poller.poll(POLL_TIMEOUT):
+          if fd == self.wake_read:
+            self.apply_listener_changes()
+            continue
+
+          handler = self.handlers.get(fd)
+          if handler is not None:
+            handler.handle(fd, events)
+
+        self.resume_listeners()
+        self.expire_connects()
+      except Exception as e:
+        logger.exception(e)
+
+    for connection in list(self.connections):
+      connection.close()
+
+    for listener in self.listeners.values():
+      listener.close()
@@ -1,10 +1,16 @@
 import subprocess
 import logging
 import psutil
+import threading
+import os
 
-from uuid import uuid4
+from collections import defaultdict
 from jinja2 import Environment, FileSystemLoader
 
+from backend import ProxyBackend
+from runtimeapi import HAProxyRuntimeAPI, HAProxyRuntimeError
+from connections import ConnectionSampler, read_tcp_connection_counts
+
 TEMPLATE_FOLDER = 'proxy'
 
 HAPROXY = 'haproxy'
@@ -12,16 +18,91 @@ HAPROXY_TEMPLATE = 'haproxy.tmpl'
 HAPROXY_PID_FILE = '/var/run/haproxy-private.pid'
 HAPROXY_CONFIG_FILE = 'haproxy.conf'
 
-CLOSE_WAIT = 'CLOSE_WAIT'
+# The pseudo server names of the frontend and backend totals in the HAProxy statistics.
+PROXY_SVNAMES = set(['FRONTEND', 'BACKEND'])
+
+# The weight of a server receiving its full share of traffic.
+DEFAULT_SERVER_WEIGHT = 100
+
+# The minimum number of server slots rendered in each backend. Slots let servers be added and
+# removed through the runtime API, without reloading HAProxy.
+BACKEND_SERVER_SLOTS = 4
 
 
 logger = logging.getLogger(__name__)
 
 
-class Proxy(object):
+def read_haproxy_pid():
+  """ Returns the PID of the current HAProxy process, as found in its PID file, or None. """
+  try:
+    with open(HAPROXY_PID_FILE) as pid_file:
+      return int(pid_file.read().strip())
+  except (IOError, ValueError):
+    return None
+
+
+def is_haproxy_process(pid):
+  """ Returns whether a HAProxy process with the given PID is running. """
+  try:
+    return psutil.Process(pid).name() == HAPROXY
+  except psutil.Error:
+    return False
+
+
+class LeftoverProcesses(object):
+  """ Tracks the HAProxy processes left over from reloads, which keep serving the connections
+      they accepted until these finish. The PID of the replaced process is recorded at each
+      reload (if it is an HAProxy process), so checking for leftovers only checks that those
+      PIDs are still HAProxy processes; the process table is only scanned once, for the
+      processes left over before this process started.
+  """
+  def __init__(self):
+    # The PIDs of the processes which may still be running, or None if not scanned yet.
+    self.pids = None
+    self.lock = threading.Lock()
+
+  def record_reload(self):
+    """ Records that the current HAProxy process is about to be replaced by a reload. """
+    pid = read_haproxy_pid()
+    with self.lock:
+      self._ensure_scanned()
+      if pid is not None and is_haproxy_process(pid):
+        self.pids.add(pid)
+
+  def has_leftovers(self):
+    """ Returns whether any HAProxy process left over from a reload is still running. """
+    with self.lock:
+      self._ensure_scanned()
+      current_pid = read_haproxy_pid()
+      self.pids = set([pid for pid in self.pids
+                       if pid != current_pid and is_haproxy_process(pid)])
+      return bool(self.pids)
+
+  def _ensure_scanned(self):
+    if self.pids is None:
+      self.pids = set([proc.pid for proc in Proxy.get_processes(old=True)])
+
+
+class Proxy(ProxyBackend):
+  """ The proxy backed by an HAProxy process, driven through its configuration file and
+      runtime API.
+  """
   def __init__(self):
-    # The registered routes, by external port number.
-    self._port_routes = {}
+    super(Proxy, self).__init__()
+
+    # The routes last committed to HAProxy, by external port number.
+    self._committed_routes = {}
+
+    # The client for the HAProxy runtime API.
+    self._runtime_api = HAProxyRuntimeAPI()
+
+    # The IP address of the container last assigned to each server slot, by (backend, server)
+    # name, used to attribute the sessions of each slot to its container.
+    self._slot_ips = {}
+
+    # The connection counts shared by all the drain checks of this proxy.
+    self._connection_sampler = ConnectionSampler(
+        lambda: Proxy.sample_connection_counts(self._slot_ips))
 
     jinja_options = {
         "loader": FileSystemLoader(TEMPLATE_FOLDER),
@@ -30,52 +111,315 @@ class Proxy(object):
     env = Environment(**jinja_options)
     self._template = env.get_template(HAPROXY_TEMPLATE)
 
+  def get_connection_counts(self):
+    """ Returns the number of connections the proxy holds, by container IP address, from the
+        connection counts sampled for all containers at once.
+    """
+    return self._connection_sampler.get_connection_counts()
+
   @staticmethod
-  def get_connections():
-    """ Returns the connection information for all proxy processes. """
-    logger.debug('Getting proxy connections')
-    connections = []
-    for proc in psutil.process_iter():
-      if proc.is_running() and proc.name() == HAPROXY:
-        connections.extend([conn for conn in proc.get_connections() if conn.status != CLOSE_WAIT])
+  def sample_connection_counts(slot_ips=None):
+    """ Returns the number of connections the proxy holds, by container IP address. The current
+        HAProxy process reports the sessions of each server slot through its runtime API, which
+        are counted against the container last assigned to the slot (as found in slot_ips), or
+        else the slot's current address. If HAProxy processes left over from a reload are still
+        serving connections (or the stats cannot be read), the connections of the host are
+        counted from its TCP tables instead.
+    """
+    if leftover_processes.has_leftovers():
+      return read_tcp_connection_counts()
+
+    try:
+      stats = HAProxyRuntimeAPI().show_stat()
+    except HAProxyRuntimeError as e:
+      logger.debug('Could not read HAProxy stats: %s', e)
+      return read_tcp_connection_counts()
+
+    counts = defaultdict(int)
+    for row in stats:
+      if row.get('svname') in PROXY_SVNAMES:
+        continue
 
-    return connections
+      container_ip = (slot_ips or {}).get((row.get('pxname'), row.get('svname')))
+      if container_ip is None:
+        if not 'addr' in row:
+          # HAProxy before 1.7 does not report server addresses.
+          return read_tcp_connection_counts()
 
-  def clear_routes(self):
-    """ Clears all routes found in the proxy. """
-    self._port_routes = {}
+        container_ip = row['addr'].rsplit(':', 1)[0]
 
-  def add_route(self, route):
-    """ Adds a route to the proxy (but does not commit the changes). """
-    self._port_routes[route.host_port] = route
+      counts[container_ip] += int(row.get('scur') or 0)
+
+    return dict(counts)
+
+  @staticmethod
+  def get_processes(old=False):
+    """ Returns the running HAProxy processes. If old is True, only returns the processes left
+        over from a reload.
+    """
+    current_pid = read_haproxy_pid() if old else None
+
+    return [proc for proc in psutil.process_iter()
+            if proc.is_running() and proc.name() == HAPROXY and proc.pid != current_pid]
 
   def shutdown(self):
     """ Shuts down the proxy entirely. """
+    self._committed_routes = {}
+    self._slot_ips = {}
     subprocess.call('./shutdown-haproxy.sh', shell=True, close_fds=True)
 
   def commit(self):
-    """ Commits the changes made to the proxy. """
-    logger.debug("Restarting haproxy with new rules.")
-
+    """ Commits the changes made to the proxy. If HAProxy is running with the same frontends,
+        the servers are changed through its runtime API. Otherwise (or if that fails), the
+        configuration is rewritten and HAProxy is reloaded.
+    """
     # If the port routes are empty, add a dummy mapping to the proxy.
     if len(self._port_routes.values()) == 0:
       self.add_route(Route(False, 65535, '127.0.0.2', 65534, is_fake=True))
 
+    # Skip the commit entirely if HAProxy is running with the same routes.
+    if self._is_committed():
+      logger.debug("Proxy routes unchanged; skipping commit.")
+      self._port_routes = dict(self._committed_routes)
+      return
+
+    if self._can_update_at_runtime():
+      try:
+        self._update_at_runtime()
+        self._write_config()
+        self._set_committed()
+        return
+      except HAProxyRuntimeError as e:
+        logger.exception(e)
+
+    logger.debug("Restarting haproxy with new rules.")
+    for route in self._port_routes.values():
+      route.assign_slots()
+
     # Write out the config.
+    self._write_config()
+    self._set_committed()
+
+    # Restart haproxy. The replaced process keeps serving its connections until they finish.
+    leftover_processes.record_reload()
+    subprocess.call('./restart-haproxy.sh', shell=True, close_fds=True)
+
+  def _set_committed(self):
+    """ Records the current routes as committed to HAProxy. """
+    self._committed_routes = dict(self._port_routes)
+
+    slot_ips = {}
+    for route in self._port_routes.values():
+      for index, container_ip in enumerate(route.slot_ips):
+        if container_ip is not None:
+          slot_ips[(route.get_backend_name(), route.get_server_name(index))] = container_ip
+
+    self._slot_ips = slot_ips
+
+  def _write_config(self):
+    """ Writes out the HAProxy configuration for the current routes. """
     rendered = self._template.render({'port_routes': self._port_routes})
     with open(HAPROXY_CONFIG_FILE, 'w') as config_file:
       config_file.write(rendered)
 
-    # Restart haproxy
-    subprocess.call('./restart-haproxy.sh', shell=True, close_fds=True)
+  def _is_committed(self):
+    """ Returns whether HAProxy is running with the current routes. """
+    if not self._committed_routes or not os.path.exists(HAPROXY_PID_FILE):
+      return False
+
+    if set(self._committed_routes.keys()) != set(self._port_routes.keys()):
+      return False
+
+    for port, route in self._port_routes.items():
+      if route.get_signature() != self._committed_routes[port].get_signature():
+        return False
+
+    return True
+
+  def _can_update_at_runtime(self):
+    """ Returns whether the current routes can be applied to the running HAProxy through its
+        runtime API: HAProxy must be running with the same frontends, and each backend must
+        have enough free slots for its new servers, not counting the slots still holding the
+        sessions of removed servers.
+    """
+    if not self._committed_routes or not os.path.exists(HAPROXY_PID_FILE):
+      return False
+
+    if set(self._committed_routes.keys()) != set(self._port_routes.keys()):
+      return False
+
+    for port, route in self._port_routes.items():
+      committed = self._committed_routes[port]
+      if committed.is_http != route.is_http or committed.is_fake != route.is_fake:
+        return False
+
+      if committed.slow_start != route.slow_start:
+        return False
+
+    # Slots whose server was removed may still carry its sessions, so they are only reused once
+    # HAProxy reports them idle.
+    try:
+      busy_servers = self._get_busy_servers()
+    except HAProxyRuntimeError as e:
+      logger.debug('Could not read HAProxy stats: %s', e)
+      return False
+
+    for route in self._port_routes.values():
+      committed = self._committed_routes[route.host_port]
+      if not route.assign_slots(committed, busy_servers.get(route.get_backend_name(), set())):
+        return False
+
+    return True
+
+  def _get_busy_servers(self):
+    """ Returns the names of the servers holding sessions, by backend name. """
+    busy_servers = defaultdict(set)
+    for row in self._runtime_api.show_stat():
+      if row.get('svname') in PROXY_SVNAMES:
+        continue
+
+      if int(row.get('scur') or 0) > 0:
+        busy_servers[row.get('pxname')].add(row.get('svname'))
+
+    return busy_servers
+
+  def _update_at_runtime(self):
+    """ Changes the servers of the running HAProxy to match the current routes. The new servers
+        are enabled before the removed ones are disabled. Removed servers are put in maintenance,
+        which stops new traffic to them but lets their existing connections finish.
+    """
+    logger.debug("Updating haproxy servers through the runtime API.")
+    removed = []
+    for port, route in self._port_routes.items():
+      committed = self._committed_routes[port]
+      backend = route.get_backend_name()
+      for index, server in enumerate(route.slots):
+        previous = committed.slots[index]
+        name = route.get_server_name(index)
+        if server is None:
+          if previous is not None:
+            removed.append((backend, name))
+
+          continue
+
+        if previous is None or previous.get_address() != server.get_address():
+          self._runtime_api.set_server_address(backend, name, server.container_ip,
+                                               server.container_port)
+          self._runtime_api.set_server_weight(backend, name, server.weight)
+          self._runtime_api.set_server_state(backend, name, 'ready')
+        elif previous.weight != server.weight:
+          self._runtime_api.set_server_weight(backend, name, server.weight)
+
+    for (backend, name) in removed:
+      self._runtime_api.set_server_state(backend, name, 'maint')
 
 
 class Route(object):
   """ A single route proxied. """
-  def __init__(self, is_http, host_port, container_ip, container_port, is_fake=False):
-    self.id = str(uuid4())
+  def __init__(self, is_http, host_port, container_ip, container_port, is_fake=False,
+               weight=DEFAULT_SERVER_WEIGHT, slow_start=0):
+    self.id = 'port_%s' % host_port
     self.is_fake = is_fake
     self.is_http = is_http
     self.host_port = host_port
     self.container_ip = container_ip
     self.container_port = container_port
+
+    # The time, in seconds, over which a newly enabled server ramps up to its full weight.
+    self.slow_start = slow_start
+
+    # The servers across which the traffic of the route is balanced.
+    self.servers = [RouteServer(container_ip, container_port, weight)]
+
+    # The server slots of the backend, each holding a server or None if unused.
+    self.slots = []
+
+    # The indexes of the unused slots whose server was removed (and may still be draining).
+    self.retired_slots = set()
+
+    # The IP address of the container last assigned to each slot, or None if never used. A
+    # removed server's slot keeps its address until reused, so its sessions are still counted
+    # against it.
+    self.slot_ips = []
+
+  def get_signature(self):
+    """ Returns a value which compares equal for routes which proxy the same way. """
+    return (self.is_http, self.is_fake, self.slow_start,
+            sorted([server.get_address() + (server.weight,) for server in self.servers]))
+
+  def get_backend_name(self):
+    """ Returns the name of the HAProxy backend of the route. """
+    return '%s-backend' % self.id
+
+  def get_server_name(self, index):
+    """ Returns the name of the HAProxy server in the given slot. """
+    return '%s-backend-%s' % (self.id, index)
+
+  def assign_slots(self, committed=None, busy_servers=()):
+    """ Assigns the servers of the route to slots. Without a committed route, the slots are laid
+        out afresh. Otherwise the committed route's slots are reused: servers keep
+        their slot and new servers take free slots, preferring slots which have never been used.
+        The slots of removed servers are only reused once idle: never in the commit removing
+        the server, nor while the slot's server name is in busy_servers (i.e. still holds
+        sessions). Returns False if there are not enough free slots.
+    """
+    if committed is None:
+      slot_count = max(BACKEND_SERVER_SLOTS, 2 * len(self.servers))
+      self.slots = self.servers + [None] * (slot_count - len(self.servers))
+      self.retired_slots = set()
+      self.slot_ips = [server.container_ip if server else None for server in self.slots]
+      return True
+
+    self.slots = [None] * len(committed.slots)
+
+    unassigned = []
+    committed_indexes = {}
+    for index, server in enumerate(committed.slots):
+      if server is not None:
+        committed_indexes[server.get_address()] = index
+
+    for server in self.servers:
+      index = committed_indexes.pop(server.get_address(), None)
+      if index is None:
+        unassigned.append(server)
+      else:
+        self.slots[index] = server
+
+    removed = sorted(committed_indexes.values())
+    unused = [index for index, server in enumerate(committed.slots)
+              if server is None and not index in committed.retired_slots]
+    idle = [index for index in sorted(committed.retired_slots)
+            if not self.get_server_name(index) in busy_servers]
+    free = unused + idle
+    if len(unassigned) > len(free):
+      return False
+
+    for server, index in zip(unassigned, free):
+      self.slots[index] = server
+
+    self.retired_slots = set([index for index in committed.retired_slots | set(removed)
+                              if self.slots[index] is None])
+    self.slot_ips = [server.container_ip if server else committed.slot_ips[index]
+                     for index, server in enumerate(self.slots)]
+    return True
+
+
+class RouteServer(object):
+  """ A single server (container address and port) of a route, with its share of the traffic
+      relative to the other servers.
+  """
+  def __init__(self, container_ip, container_port, weight=DEFAULT_SERVER_WEIGHT):
+    self.container_ip = container_ip
+    self.container_port = container_port
+    self.weight = weight
+
+  def get_address(self):
+    """ Returns the (address, port) of the server. """
+    return (self.container_ip, self.container_port)
+
+
+# The HAProxy processes left over from reloads.
+leftover_processes = LeftoverProcesses()
+
+# The connection counts shared by all the drain checks, when no proxy was built.
+connection_sampler = ConnectionSampler(Proxy.sample_connection_counts)
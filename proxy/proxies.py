@@ -0,0 +1,39 @@
+from portproxy import Proxy, connection_sampler
+from engine import ProxyEngine
+from util import fail
+
+# The registered proxy engines.
+PROXY_ENGINES = {
+  'haproxy': Proxy,
+  'builtin': ProxyEngine,
+}
+
+# The proxy engines which run inside the process, and so are only usable by gantryd: in a
+# short-lived process they would take the external ports from gantryd and drop all the traffic
+# on exit.
+IN_PROCESS_ENGINES = set(['builtin'])
+
+# The proxy built for this process, if any.
+active_proxy = None
+
+def buildProxy(kind, in_daemon=False):
+  """ Builds the proxy engine of the given kind, making it the proxy of this process. In-process
+      engines can only be built by gantryd.
+  """
+  global active_proxy
+  if not kind in PROXY_ENGINES:
+    fail('Unknown proxy engine: ' + kind)
+
+  if kind in IN_PROCESS_ENGINES and not in_daemon:
+    fail('The %s proxy engine can only be used by gantryd' % kind)
+
+  active_proxy = PROXY_ENGINES[kind]()
+  return active_proxy
+
+def getContainerConnectionCount(container_ip):
+  """ Returns the number of connections the proxy of this process holds to the given container.
+  """
+  if active_proxy is None:
+    return connection_sampler.get_connection_count(container_ip)
+
+  return active_proxy.get_container_connection_count(container_ip)
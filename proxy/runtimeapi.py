@@ -0,0 +1,90 @@
+import socket
+import logging
+
+HAPROXY_STATS_SOCKET = '/var/run/haproxy.sock'
+RUNTIME_API_TIMEOUT = 5 # 5 seconds
+
+
+logger = logging.getLogger(__name__)
+
+
+class HAProxyRuntimeError(Exception):
+  """ Raised when a command sent to the HAProxy runtime API fails. """
+  pass
+
+
+class HAProxyRuntimeAPI(object):
+  """ Client for the runtime API exposed by HAProxy on its (admin level) stats socket. Each
+      command is sent on its own connection.
+  """
+  def __init__(self, socket_path=HAPROXY_STATS_SOCKET, timeout=RUNTIME_API_TIMEOUT):
+    self.socket_path = socket_path
+    self.timeout = timeout
+
+  def execute(self, command):
+    """ Sends the given command, returning the response. Raises a HAProxyRuntimeError if the
+        socket cannot be reached.
+    """
+    logger.debug('Sending HAProxy command: %s', command)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.settimeout(self.timeout)
+      sock.connect(self.socket_path)
+      sock.sendall(command + '\n')
+
+      chunks = []
+      while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+          break
+
+        chunks.append(chunk)
+
+      return ''.join(chunks)
+    except socket.error as e:
+      raise HAProxyRuntimeError('Could not reach HAProxy runtime API: %s' % e)
+    finally:
+      sock.close()
+
+  def execute_checked(self, command):
+    """ Sends the given command, which returns nothing on success, raising a HAProxyRuntimeError
+        with the response otherwise.
+    """
+    response = self.execute(command).strip()
+    if response:
+      raise HAProxyRuntimeError('HAProxy command "%s" failed: %s' % (command, response))
+
+  def set_server_address(self, backend, server, address, port):
+    """ Changes the address and port of the given server. """
+    response = self.execute('set server %s/%s addr %s port %s' % (backend, server, address, port))
+
+    # HAProxy reports the change on success.
+    if 'changed' not in response and 'no need to change' not in response:
+      raise HAProxyRuntimeError('Could not change address of %s/%s: %s' %
+                                (backend, server, response.strip()))
+
+  def set_server_state(self, backend, server, state):
+    """ Changes the administrative state of the given server to one of 'ready', 'drain' or
+        'maint'.
+    """
+    self.execute_checked('set server %s/%s state %s' % (backend, server, state))
+
+  def set_server_weight(self, backend, server, weight):
+    """ Changes the weight of the given server. """
+    self.execute_checked('set weight %s/%s %s' % (backend, server, weight))
+
+  def show_stat(self):
+    """ Returns the statistics of all the frontends, backends and servers, as a list of dicts
+        keyed by the CSV column names (pxname, svname, scur, addr, ...).
+    """
+    lines = self.execute('show stat').splitlines()
+    if not lines or not lines[0].startswith('#'):
+      raise HAProxyRuntimeError('Unexpected response to show stat')
+
+    columns = lines[0][1:].strip().split(',')
+    stats = []
+    for line in lines[1:]:
+      if line.strip():
+        stats.append(dict(zip(columns, line.split(','))))
+
+    return stats
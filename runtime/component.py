@@ -1,13 +1,89 @@
-from threading import Thread, Event
+from threading import Thread
+from functools import partial
 
 from health.checks import buildHealthCheck
-from metadata import (getContainerStatus, setContainerStatus, removeContainerMetadata,
-                      getContainerComponent, setContainerComponent)
+from health.dockercheck import DockerHealthCheck
+from health.readiness import ReadyCheckEngine
+from metadata import (setContainerStatus, removeContainerMetadata, getContainerStatuses,
+                      setContainerStatuses, getContainerComponent, setContainerComponent,
+                      getComponentField, setComponentField)
 from util import report, fail, getDockerClient, ReportLevels
-
+from containerutil import (LABEL_PROJECT, LABEL_COMPONENT, LABEL_GENERATION, LABEL_CONFIG_HASH,
+                           getContainerLabel, inspectContainer)
+from events import IMAGE_EVENT, CONTAINER_EVENT
+from phases import PhaseTimer, runInParallel
+from proxy.portproxy import DEFAULT_SERVER_WEIGHT
+
+import docker
+import hashlib
+import json
+import threading
 import time
 import logging
 
+IMAGE_CACHE_TTL = 300 # 5 minutes
+
+# The image event actions after which a cached image resolution may be stale.
+IMAGE_INVALIDATING_ACTIONS = set(['pull', 'tag', 'untag', 'delete', 'import', 'load'])
+
+class ImageCache(object):
+  """ Cache of image inspections, keyed by named image (repo:tag). Entries expire after the
+      TTL and are refreshed on local pulls and image events from the Docker events stream.
+  """
+  def __init__(self, ttl=IMAGE_CACHE_TTL):
+    self.lock = threading.Lock()
+
+    # The time, in seconds, after which a cached entry expires.
+    self.ttl = ttl
+
+    # The cached (inspection, timestamp) pairs, by named image.
+    self.entries = {}
+
+  def inspect(self, client, named_image):
+    """ Returns the inspection information for the given named image. Raises if the image
+        is not present locally.
+    """
+    with self.lock:
+      if named_image in self.entries:
+        (image_info, timestamp) = self.entries[named_image]
+        if time.time() - timestamp <= self.ttl:
+          return image_info
+
+    image_info = client.inspect_image(named_image)
+    with self.lock:
+      self.entries[named_image] = (image_info, time.time())
+
+    return image_info
+
+  def isPresent(self, client, named_image):
+    """ Returns whether the given named image is present locally. """
+    try:
+      self.inspect(client, named_image)
+      return True
+    except docker.errors.NotFound:
+      return False
+
+  def invalidate(self, named_image):
+    """ Removes the cached entry for the given named image. """
+    with self.lock:
+      self.entries.pop(named_image, None)
+
+  def handleEvent(self, event):
+    """ Invalidates the entries referenced by the given Docker image event, either by name
+        or by image ID.
+    """
+    if event.kind != IMAGE_EVENT or not event.action in IMAGE_INVALIDATING_ACTIONS:
+      return
+
+    references = set([event.id, event.attributes.get('name')])
+    with self.lock:
+      for named_image, (image_info, _) in self.entries.items():
+        if named_image in references or image_info['Id'] in references:
+          del self.entries[named_image]
+
+
+image_cache = ImageCache()
+
 class Component(object):
   """ A component that can be/is running. Tracks all the runtime information
       for a component.
@@ -21,6 +97,26 @@ class Component(object):
 
     # The underlying config for the component.
     self.config = config
+
+    # The ID of the warm standby container for the component (None if none), loaded from
+    # the component's metadata on first use.
+    self.standby_container_id = None
+    self.standby_loaded = False
+
+    # Lock protecting the creation and use of the warm standby container.
+    self.standby_lock = threading.Lock()
+
+    # The engine running the ready checks of a new container, if any.
+    self.ready_engine = None
+
+    # The proxy weights of the containers sharing traffic during a rollout, by container ID.
+    self.route_weights = {}
+    manager.events.addListener(self.handleDockerEvent)
+
+    # A warm standby left over from an earlier run may have been created from another
+    # configuration, so it is never reused.
+    if getComponentField(self.getName(), 'standby-container', ''):
+      self.discardStandby()
     
   def applyConfigOverrides(self, config_overrides):
     """ Applies the list of configuration overrides to this component's config.
@@ -29,6 +125,8 @@ class Component(object):
     """
     for override in config_overrides:
       self.config.applyOverride(override)
+
+    self.config.validate()
     
   def getName(self):
     """ Returns the name of the component. """
@@ -48,15 +146,20 @@ class Component(object):
     return len(self.getAllContainers(client)) > 0
 
   def getPrimaryContainer(self):
-    """ Returns the container for this component that is not marked as draining or None if
+    """ Returns a container for this component that is not marked as draining or None if
         none.
     """
-    client = getDockerClient()
-    for container in self.getAllContainers(client):
-      if getContainerStatus(container) != 'draining':
-        return container
+    containers = self.getPrimaryContainers()
+    return containers[0] if containers else None
 
-    return None
+  def getPrimaryContainers(self):
+    """ Returns the containers (one per replica) for this component that are not marked as
+        draining.
+    """
+    client = getDockerClient()
+    containers = self.getAllContainers(client)
+    statuses = getContainerStatuses(containers)
+    return [container for container in containers if statuses[container['Id']] != 'draining']
 
   def getImageId(self):
     """ Returns the docker ID of the image used for this component. Note that this
@@ -65,53 +168,129 @@ class Component(object):
     client = getDockerClient()
     named_image = self.config.getFullImage()
     self.logger.debug('Finding image ID for component %s with named image %s', self.getName(), named_image)
-    result = client.inspect_image(named_image)
+    result = image_cache.inspect(client, named_image)
     return result['Id']
 
   def pullRepo(self):
     """ Attempts to pull the repo for this component. On failure, returns False. """
-    try:
-      self.logger.debug('Attempting to pull repo for component %s: %s:%s', self.getName(), self.config.repo, self.config.tag)
-      client = getDockerClient()
-      client.pull(self.config.repo, tag=self.config.tag)
-      return True
-    except Exception as e:
-      self.logger.exception(e)
+    self.logger.debug('Attempting to pull repo for component %s: %s:%s', self.getName(), self.config.repo, self.config.tag)
+    if not self.manager.pulls.pull(self.config.repo, self.config.tag, component=self):
       return False
 
+    image_cache.invalidate(self.config.getFullImage())
+    return True
+
   def update(self):
     """ Updates a running instance of the component. Returns True on success and False
-        otherwise.
+        otherwise. Each replica is replaced in turn: a new container is started, traffic is
+        balanced onto it and the replica it replaces is drained, before moving on to the next.
+        If rollout weights are configured, the traffic of the replaced replica is shifted onto
+        the new container step by step, and the replica only drains once it has none left.
     """
     self.logger.debug('Updating component %s', self.getName())
-    client = getDockerClient()
+    timer = PhaseTimer()
+
+    # Get the list of currently running primary container(s).
+    with timer.phase('existing'):
+      existing_primaries = self.getPrimaryContainers()
+
+    replicas = max(1, self.config.replicas)
+    for index in range(replicas):
+      # Start the new instance.
+      container = self.start(timer)
+      if not container:
+        report('Update failed after ' + timer.getSummary(), component=self,
+               level=ReportLevels.EXTRA)
+        return False
 
-    # Get the list of currently running container(s).
-    existing_containers = self.getAllContainers(client)
-    existing_primary = self.getPrimaryContainer()
+      # Shift the traffic of the replica being replaced onto the new container.
+      if index < len(existing_primaries) and self.config.getRolloutWeights():
+        try:
+          shifted = self.shiftTraffic(container, existing_primaries[index], timer)
+        except Exception:
+          self.clearRouteWeights([container, existing_primaries[index]])
+          raise
+
+        if not shifted:
+          setContainerStatus(container, 'draining')
+          self.clearRouteWeights([container, existing_primaries[index]])
+          self.manager.adjustForUpdatingComponent(self, container)
+          self.manager.terminateContainer(container, self)
+          report('Update failed after ' + timer.getSummary(), component=self,
+                 level=ReportLevels.EXTRA)
+          return False
+
+      # Mark the container being replaced as draining. On the last replica, any extra
+      # existing containers (e.g. when scaling down) are drained as well.
+      replaced = existing_primaries[index:index + 1]
+      if index == replicas - 1:
+        replaced = existing_primaries[index:]
+
+      with timer.phase('drain'):
+        setContainerStatuses(replaced, 'draining')
+
+      # The rollout weights are kept until the replaced container is draining, so that a proxy
+      # update in between does not send traffic back to it.
+      self.clearRouteWeights([container] + replaced)
+
+      # Update the port proxy to redirect the external ports to the new
+      # container.
+      report('Redirecting traffic to new container', component=self)
+      with timer.phase('proxy'):
+        self.manager.adjustForUpdatingComponent(self, container)
+
+      # Signal the replaced container(s) to terminate
+      for existing in replaced:
+        self.manager.terminateContainer(existing, self)
+
+    report('Update completed in ' + timer.getSummary(), component=self, level=ReportLevels.EXTRA)
+
+    # Prepare the next container in the background, if requested.
+    if self.config.warm_standby:
+      standby_thread = Thread(target=self.prepareStandby, args=[])
+      standby_thread.daemon = True
+      standby_thread.start()
 
-    # Start the new instance.
-    container = self.start()
-    if not container:
-      return False
+    return True
 
-    # Mark all the existing containers as draining.
-    for existing in existing_containers:
-      setContainerStatus(existing, 'draining')
+  def shiftTraffic(self, container, replaced, timer):
+    """ Shifts the traffic of the replaced container onto the new container, following the
+        configured rollout weights, with rolloutStepTime seconds between steps. Returns False if
+        the new container stops running during the rollout. The weights of both containers are
+        left in place for the caller to clear (with clearRouteWeights) once it has marked the
+        container losing the traffic as draining.
+    """
+    client = getDockerClient()
+    for step, weight in enumerate(self.config.getRolloutWeights()):
+      if step > 0:
+        time.sleep(self.config.rollout_step_time)
 
-    # Update the port proxy to redirect the external ports to the new
-    # container.
-    report('Redirecting traffic to new container', component=self)
-    self.manager.adjustForUpdatingComponent(self, container)
+      if not inspectContainer(client, container)['State'].get('Running'):
+        report('New container stopped during rollout', component=self)
+        return False
 
-    # Signal the existing primary container to terminate
-    if existing_primary is not None:
-      self.manager.terminateContainer(existing_primary, self)
+      report('Shifting %s%% of traffic to new container' % weight, component=self)
+      self.route_weights[container['Id']] = DEFAULT_SERVER_WEIGHT * weight / 100
+      self.route_weights[replaced['Id']] = DEFAULT_SERVER_WEIGHT * (100 - weight) / 100
+      with timer.phase('shift'):
+        self.manager.adjustForUpdatingComponent(self, container)
 
     return True
 
+  def clearRouteWeights(self, containers):
+    """ Clears the rollout weights of the given containers. """
+    for container in containers:
+      self.route_weights.pop(container['Id'], None)
+
+  def getRouteWeight(self, container):
+    """ Returns the proxy weight of the given container. """
+    return self.route_weights.get(container['Id'], DEFAULT_SERVER_WEIGHT)
+
   def stop(self, kill=False):
     """ Stops all containers for this component. """
+    self.cancelReadyCheck()
+    self.discardStandby()
+
     if not self.isRunning():
       return
 
@@ -120,8 +299,9 @@ class Component(object):
 
     # Mark all the containers as draining.
     report('Draining all containers...', component=self)
-    for container in self.getAllContainers(client):
-      setContainerStatus(container, 'draining')
+    containers = self.getAllContainers(client)
+    setContainerStatuses(containers, 'draining')
+    for container in containers:
       self.manager.terminateContainer(container, self)
 
     # Kill any associated containers if asked.
@@ -131,6 +311,8 @@ class Component(object):
         client.kill(container)
         removeContainerMetadata(container)
 
+      self.manager.invalidateContainers()
+
     # Clear the proxy and rebuild its routes for the running components.
     self.manager.adjustForStoppingComponent(self)
 
@@ -139,129 +321,324 @@ class Component(object):
     client = getDockerClient()
     information = []
 
-    for container in self.getAllContainers(client):
-      information.append((container, getContainerStatus(container)))
+    containers = self.getAllContainers(client)
+    statuses = getContainerStatuses(containers)
+    for container in containers:
+      information.append((container, statuses[container['Id']]))
 
     return information
 
   def isHealthy(self):
-    """ Runs the health checks on this component's container, ensuring that it is healthy.
-        Returns True if healthy and False otherwise.
+    """ Runs the health checks on this component's containers, ensuring that all replicas are
+        running and healthy. Returns True if healthy and False otherwise.
     """
     self.logger.debug('Checking if component %s is healthy...', self.getName())
-    container = self.getPrimaryContainer()
-    if not container:
-      self.logger.debug('No container running for component %s', self.getName())
+    containers = self.getPrimaryContainers()
+    if len(containers) < max(1, self.config.replicas):
+      self.logger.debug('Not all replicas running for component %s', self.getName())
       return False
 
+    return self.checkHealth(containers)
+
+  def checkHealth(self, containers):
+    """ Runs the health checks on the given containers. Returns True if all of them are
+        healthy and False otherwise.
+    """
     checks = []
     for check in self.config.health_checks:
       checks.append((check, buildHealthCheck(check)))
 
-    for (config, check) in checks:
-      report('Running health check: ' + config.getTitle(), component=self)
-      result = check.run(container, report)
-      if not result:
-        report('Health check failed', component=self)
-        return False
+    for container in containers:
+      for (config, check) in checks:
+        report('Running health check: ' + config.getTitle(), component=self)
+        result = check.run(container, report)
+        if not result:
+          report('Health check failed', component=self)
+          return False
 
     self.logger.debug('Component %s is healthy', self.getName())
     return True
 
+  def repair(self, kill=False):
+    """ Restores a component found unhealthy. If the running replicas are healthy and only
+        some are missing, just the missing replicas are started. Otherwise all the replicas are
+        replaced (after killing the existing containers, if kill is True). Returns True on
+        success and False otherwise.
+    """
+    containers = self.getPrimaryContainers()
+    missing = max(1, self.config.replicas) - len(containers)
+    if containers and missing > 0 and self.checkHealth(containers):
+      return self.startMissingReplicas(missing)
+
+    if kill:
+      self.stop(kill=True)
+
+    return self.update()
+
+  def startMissingReplicas(self, count):
+    """ Starts the given number of new replicas alongside the running ones, adding each to the
+        proxy once ready. Returns True on success and False otherwise.
+    """
+    report('Starting %s missing replica(s)' % count, component=self)
+    timer = PhaseTimer()
+    for _ in range(count):
+      container = self.start(timer)
+      if not container:
+        report('Starting missing replicas failed after ' + timer.getSummary(), component=self,
+               level=ReportLevels.EXTRA)
+        return False
+
+      with timer.phase('proxy'):
+        self.manager.adjustForUpdatingComponent(self, container)
+
+    report('Missing replicas started in ' + timer.getSummary(), component=self,
+           level=ReportLevels.EXTRA)
+    return True
+
   ######################################################################
 
-  def readyCheck(self, container, timeout):
+  def buildReadyChecks(self):
+    """ Returns the (config, check) pairs of the ready checks for this component. If none are
+        configured and the component's image defines a Docker HEALTHCHECK, its status is used.
+    """
+    if not self.config.ready_checks and self.hasDockerHealthcheck():
+      docker_check = self.config.docker_ready_check
+      return [(docker_check, DockerHealthCheck(docker_check))]
+
+    return [(check, buildHealthCheck(check)) for check in self.config.ready_checks]
+
+  def hasDockerHealthcheck(self):
+    """ Returns whether the image of this component defines a Docker HEALTHCHECK. """
+    try:
+      image_info = image_cache.inspect(getDockerClient(), self.config.getFullImage())
+    except docker.errors.NotFound:
+      return False
+
+    healthcheck = (image_info.get('Config') or {}).get('Healthcheck') or {}
+    return bool(healthcheck.get('Test')) and healthcheck['Test'] != ['NONE']
+
+  def readyCheck(self, container):
     """ Method which performs ready health check(s) on a container, returning whether
-        they succeeded or not.
+        they succeeded or not. The checks can be cancelled via cancelReadyCheck().
 
         container: The container running the component that will be checked.
-        timeout: The amount of time after which the checks have timed out.
     """
     self.logger.debug('Checking if component %s is ready...', self.getName())
-    checks = []
-    for check in self.config.ready_checks:
-      checks.append((check, buildHealthCheck(check)))
-
-    start = time.time()
-    while True:
-      now = time.time()
-      if now - start > timeout:
-        # Timed out completely.
-        self.logger.debug('Component %s ready checks have timed out')
-        return False
-
-      # Try each check. If any fail, we'll sleep and try again.
-      check_failed = None
-      for (config, check) in checks:
-        report('Running health check: ' + config.getTitle(), component=self)
-        result = check.run(container, report)
-        if not result:
-          report('Health check failed', component=self)
-          check_failed = config
-          break
-
-      if check_failed:
-        report('Sleeping ' + str(check_failed.timeout) + ' second(s)...', component=self)
-        time.sleep(check_failed.timeout)
-      else:
-        break
+    engine = ReadyCheckEngine(self.buildReadyChecks(), container,
+                              self.config.getReadyCheckTimeout(), partial(report, component=self))
+    self.ready_engine = engine
+    try:
+      return engine.run()
+    finally:
+      self.ready_engine = None
+
+  def cancelReadyCheck(self):
+    """ Cancels the ready checks currently running, if any. """
+    engine = self.ready_engine
+    if engine is not None:
+      engine.cancel()
+
+  def handleDockerEvent(self, event):
+    """ Handles an event from the Docker events stream, waking the running ready checks when
+        the health of the container being checked changes, or cancelling them if it died.
+    """
+    engine = self.ready_engine
+    if engine is None or event.kind != CONTAINER_EVENT or event.id != engine.getContainerId():
+      return
 
-    return True
+    if event.action == 'health_status':
+      engine.wake()
+    elif event.action == 'die':
+      engine.cancel()
 
-  def start(self):
-    """ Starts a new instance of the component. Note that this does *not* update the proxy. """
+  def start(self, timer=None):
+    """ Starts a new instance of the component. Note that this does *not* update the proxy.
+        The time spent in each phase of the start is recorded in the given PhaseTimer, if any.
+    """
     client = getDockerClient()
+    timer = timer or PhaseTimer()
     self.logger.debug('Starting container for component %s', self.getName())
 
-    # Ensure that we have the image. If not, we try to download it.
-    self.ensureImage(client)
-
-    # Start the instance with the proper image ID.
-    container = self.createContainer(client)
-    report('Starting container ' + container['Id'][:12], component=self)
-
-    if self.config.privileged:
-      report('Container will be run in privileged mode', component=self)
+    # Use the warm standby container, if any.
+    with timer.phase('standby'):
+      container = self.takeStandby(client)
 
-    client.start(container, binds=self.config.getBindings(container['Id']),
-                 volumes_from=self.config.volumes_from,
-                 privileged=self.config.privileged)
+    if container is None:
+      # Start the instance with the proper image ID.
+      container = self.createContainer(client, timer)
+      with timer.phase('start'):
+        self.startContainer(client, container)
 
     # Health check until the instance is ready.
     report('Waiting for health checks...', component=self)
 
-    # Start a health check thread to determine when the component is ready.
-    timeout = self.config.getReadyCheckTimeout()
-    readycheck_thread = Thread(target=self.readyCheck, args=[container, timeout])
-    readycheck_thread.daemon = True
-    readycheck_thread.start()
-
-    # Wait for the health thread to finish.
-    readycheck_thread.join(self.config.getReadyCheckTimeout())
+    with timer.phase('ready'):
+      # Record the owner of the container while the checks run.
+      (ready, _) = runInParallel(lambda: self.readyCheck(container),
+                                 lambda: setContainerComponent(container, self.getName()))
 
-    # If the thread is still alived, then our join timed out.
-    if readycheck_thread.isAlive():
+    if not ready:
       report('Timed out waiting for health checks. Stopping container...', component=self)
       client.stop(container)
+      self.manager.invalidateContainers()
       report('Container stopped', component=self)
       return None
 
     # Otherwise, the container is ready. Set it as starting.
-    setContainerComponent(container, self.getName())
     setContainerStatus(container, 'starting')
     return container
 
+  def startContainer(self, client, container):
+    """ Starts the given (created) container. """
+    report('Starting container ' + container['Id'][:12], component=self)
+
+    if self.config.privileged:
+      report('Container will be run in privileged mode', component=self)
+
+    if self.config.hasContainerIdBindings():
+      # The bindings depend on the container's ID, so they can only be given on start.
+      client.start(container, binds=self.config.getBindings(container['Id']),
+                   volumes_from=self.config.volumes_from,
+                   privileged=self.config.privileged)
+    else:
+      client.start(container)
+
+    self.manager.invalidateContainers()
+
+  def getStandbyContainerId(self):
+    """ Returns the ID of the warm standby container for this component or None if none. """
+    if not self.standby_loaded:
+      self.standby_container_id = getComponentField(self.getName(), 'standby-container', '') or None
+      self.standby_loaded = True
+
+    return self.standby_container_id
+
+  def setStandbyContainerId(self, container_id):
+    """ Sets (or clears, if None) the ID of the warm standby container for this component. """
+    self.standby_container_id = container_id
+    self.standby_loaded = True
+    setComponentField(self.getName(), 'standby-container', container_id or '')
+
+  def prepareStandby(self):
+    """ Creates (and, if configured, starts) a warm standby container for this component, off
+        the proxy, so that the next restart or redeploy of the same image only needs to run
+        the ready checks and swap the proxy.
+    """
+    with self.standby_lock:
+      if self.getStandbyContainerId():
+        return
+
+      try:
+        client = getDockerClient()
+        container = self.createContainer(client, standby=True)
+        setContainerStatus(container, 'standby')
+        self.setStandbyContainerId(container['Id'])
+        report('Created warm standby container ' + container['Id'][:12], component=self,
+               level=ReportLevels.EXTRA)
+
+        if self.config.warm_standby_started:
+          self.startContainer(client, container)
+      except Exception as e:
+        self.logger.exception(e)
+
+  def takeStandby(self, client):
+    """ Returns the warm standby container for this component, started, if it can be used in
+        place of a new container, or None otherwise. The standby is no longer tracked as such
+        once returned.
+    """
+    with self.standby_lock:
+      container_id = self.getStandbyContainerId()
+      if not container_id:
+        return None
+
+      self.setStandbyContainerId(None)
+      try:
+        container_info = client.inspect_container(container_id)
+        state = container_info['State']
+        never_started = state.get('StartedAt', '').startswith('0001-01-01')
+        labels = (container_info.get('Config') or {}).get('Labels') or {}
+        usable = (container_info['Image'] == self.getImageId() and
+                  (state.get('Running') or never_started) and
+                  labels.get(LABEL_CONFIG_HASH) == self.getConfigHash(client))
+      except Exception as e:
+        self.logger.exception(e)
+        return None
+
+      container = {'Id': container_id}
+      if not usable:
+        self.removeStandby(client, container_id)
+        return None
+
+      report('Using warm standby container ' + container_id[:12], component=self)
+      if not state.get('Running'):
+        self.startContainer(client, container)
+
+      return container
+
+  def discardStandby(self):
+    """ Removes the warm standby container for this component, if any. """
+    with self.standby_lock:
+      container_id = self.getStandbyContainerId()
+      if not container_id:
+        return
+
+      self.setStandbyContainerId(None)
+      self.removeStandby(getDockerClient(), container_id)
+
+  def removeStandby(self, client, container_id):
+    """ Force removes the given standby container. """
+    report('Removing warm standby container ' + container_id[:12], component=self,
+           level=ReportLevels.EXTRA)
+    try:
+      client.remove_container(container_id, force=True)
+      self.manager.invalidateContainers()
+    except Exception as e:
+      self.logger.exception(e)
+
+    removeContainerMetadata(container_id)
+
   def getAllContainers(self, client):
-    """ Returns all the matching containers for this component. """
+    """ Returns all the matching containers for this component. Note that the warm standby
+        container, if any, is not included.
+    """
+    standby_container_id = self.getStandbyContainerId()
     containers = []
-    for container in client.containers():
-      containerName = getContainerComponent(container)
-      if ((not containerName and container['Image'] == self.config.getFullImage()) or
-          containerName == self.getName()):
+    for container in self.manager.getContainers(client):
+      if container['Id'] == standby_container_id:
+        continue
+
+      component_name = getContainerLabel(container, LABEL_COMPONENT)
+      if component_name == self.getName() or (not component_name and
+                                               self.ownsLegacyContainer(container)):
         containers.append(container)
 
     return containers
 
+  def ownsLegacyContainer(self, container):
+    """ Returns whether the given unlabelled container, started by an earlier version of gantry,
+        belongs to this component, by the component recorded in its metadata. Earlier versions
+        recorded the owner of every container which passed its ready checks; other unlabelled
+        containers (e.g. a one-off run of the same image) are never claimed.
+    """
+    return getContainerComponent(container) == self.getName()
+
+  def getLabels(self):
+    """ Returns the labels to place on a new container for this component. Each new container
+        is given the next generation number for the component.
+    """
+    generation = int(getComponentField(self.getName(), 'generation', 0)) + 1
+    setComponentField(self.getName(), 'generation', generation)
+
+    labels = {
+      LABEL_COMPONENT: self.getName(),
+      LABEL_GENERATION: str(generation)
+    }
+
+    if self.manager.project_name:
+      labels[LABEL_PROJECT] = self.manager.project_name
+
+    return labels
+
   def calculateEnvForComponent(self):
     """ Calculates the dict of environment variables for this component. """
     links = self.config.getComponentLinks()
@@ -300,24 +677,89 @@ class Component(object):
 
     return environment
 
-  def createContainer(self, client):
-    """ Creates a docker container for this component and returns it. """
-    command = self.getCommand()
-    if not command:
-      fail('No command defined in either gantry config or docker image for component ' +
-           self.getName(), component=self)
+  def createContainer(self, client, timer=None, standby=False):
+    """ Creates a docker container for this component and returns it. The image, command,
+        environment and labels for the container are resolved concurrently. A standby
+        container is labelled with the hash of its configuration.
+    """
+    timer = timer or PhaseTimer()
+    with timer.phase('prepare'):
+      (command, environment, labels) = runInParallel(self.prepareCommand,
+                                                     self.calculateEnvForComponent,
+                                                     self.getLabels)
 
     self.logger.debug('Starting container for component %s with command %s', self.getName(),
                       command)
-                      
-    container = client.create_container(self.config.getFullImage(), command,
-                                        user=self.config.getUser(),
-                                        volumes=self.config.getVolumes(),
-                                        ports=[str(p) for p in self.config.getContainerPorts()],
-                                        environment=self.calculateEnvForComponent())
+
+    parameters = self.buildCreateParameters(client, command, environment)
+    if standby:
+      labels[LABEL_CONFIG_HASH] = self.hashCreateParameters(parameters)
+
+    with timer.phase('create'):
+      container = client.create_container(self.config.getFullImage(), labels=labels,
+                                          **parameters)
 
     return container
 
+  def buildCreateParameters(self, client, command, environment):
+    """ Returns the docker create_container parameters (besides the image and labels) for a
+        new container of this component, running the given command in the given environment.
+    """
+    return {
+      'command': command,
+      'user': self.config.getUser(),
+      'volumes': self.config.getVolumes(),
+      'ports': sorted([str(p) for p in self.config.getContainerPorts()]),
+      'environment': environment,
+      'host_config': self.createHostConfig(client),
+    }
+
+  def hashCreateParameters(self, parameters):
+    """ Returns a hash of the given create parameters and of the settings applied when the
+        container is started.
+    """
+    settings = dict(parameters)
+    settings['start'] = {
+      'bindings': {binding.external: binding.volume for binding in self.config.bindings},
+      'volumes_from': self.config.volumes_from,
+      'privileged': self.config.privileged,
+    }
+
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str)).hexdigest()
+
+  def getConfigHash(self, client):
+    """ Returns the hash of the configuration a new container of this component would be
+        created with.
+    """
+    (command, environment) = runInParallel(self.prepareCommand, self.calculateEnvForComponent)
+    return self.hashCreateParameters(self.buildCreateParameters(client, command, environment))
+
+  def createHostConfig(self, client):
+    """ Creates the docker host config (resource limits, bindings, etc) for a new container of
+        this component.
+    """
+    # Resource limits cannot be combined with {container_id} bindings (see validate).
+    options = self.config.getResourceOptions()
+    if not self.config.hasContainerIdBindings():
+      options['binds'] = self.config.getBindings('')
+      options['volumes_from'] = self.config.volumes_from
+      options['privileged'] = self.config.privileged
+
+    return client.create_host_config(**options)
+
+  def prepareCommand(self):
+    """ Ensures that the image for this component is present and returns the command to run
+        in its container, failing if none.
+    """
+    self.ensureImage(getDockerClient())
+
+    command = self.getCommand()
+    if not command:
+      fail('No command defined in either gantry config or docker image for component ' +
+           self.getName(), component=self)
+
+    return command
+
   def getCommand(self):
     """ Returns the command to run or None if none found. """
     config_command = self.config.getCommand()
@@ -326,7 +768,7 @@ class Component(object):
 
     client = getDockerClient()
     named_image = self.config.getFullImage()
-    result = client.inspect_image(named_image)
+    result = image_cache.inspect(client, named_image)
     container_cfg = result['Config']
     if not 'Cmd' in container_cfg:
       return None
@@ -337,13 +779,8 @@ class Component(object):
     """ Ensures that the image for this component is present locally. If not,
         we attempt to pull the image.
     """
-    images = client.images(name=self.config.repo)
-    if images:
-      for image in images:
-        if 'RepoTags' in image.keys() and self.config.getFullImage() in image['RepoTags']:
-          return
+    if image_cache.isPresent(client, self.config.getFullImage()):
+      return
 
-    try:
-      client.pull(self.config.repo, tag=self.config.tag)
-    except Exception as e:
-      fail('Could not pull repo ' + self.config.repo, component=self, exception=str(e))
+    if not self.pullRepo():
+      fail('Could not pull repo ' + self.config.repo, component=self)
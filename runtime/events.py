@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+import logging
+
+from util import getDockerClient
+
+RECONNECT_SLEEP_TIME = 5 # 5 seconds
+
+CONTAINER_EVENT = 'container'
+IMAGE_EVENT = 'image'
+NETWORK_EVENT = 'network'
+
+class DockerEvent(object):
+  """ A single event received from the Docker events stream. Normalizes both the legacy
+      ({status, id, from}) and the current ({Type, Action, Actor}) event formats.
+  """
+  def __init__(self, raw):
+    if 'Type' in raw:
+      actor = raw.get('Actor') or {}
+
+      # The kind of object the event is about: container, image, network, etc.
+      self.kind = raw['Type']
+
+      # The action, without any details (e.g. 'health_status: healthy' -> 'health_status').
+      self.action = raw.get('Action', '').split(':')[0].strip()
+
+      # The ID of the object (container ID, image ID or name, network ID).
+      self.id = actor.get('ID', '')
+
+      # Any attributes sent with the event.
+      self.attributes = actor.get('Attributes') or {}
+    else:
+      # Legacy events only carry a 'from' field for container events.
+      self.kind = CONTAINER_EVENT if 'from' in raw else IMAGE_EVENT
+      self.action = raw.get('status', '').split(':')[0].strip()
+      self.id = raw.get('id', '')
+      self.attributes = {'image': raw['from']} if 'from' in raw else {}
+
+  def getContainerId(self):
+    """ Returns the ID of the container this event applies to or None if none. """
+    if self.kind == CONTAINER_EVENT:
+      return self.id
+
+    if self.kind == NETWORK_EVENT:
+      return self.attributes.get('container')
+
+    return None
+
+
+class DockerEventStream(object):
+  """ Listens to the Docker events stream on a background thread and dispatches each event
+      to the registered listeners. Status listeners are told whenever the stream connects or
+      disconnects, as any events sent while disconnected are lost.
+  """
+  def __init__(self):
+    # Logging.
+    self.logger = logging.getLogger(__name__)
+
+    # The callbacks invoked with each DockerEvent received.
+    self.listeners = []
+
+    # The callbacks invoked with True or False when the stream (dis)connects.
+    self.status_listeners = []
+
+    # Whether the stream is currently connected.
+    self.connected = False
+
+    # The thread reading the stream.
+    self.thread = threading.Thread(target=self.readEvents, args=[])
+    self.thread.daemon = True
+
+  def addListener(self, listener):
+    """ Registers a callback to be invoked with each event received. """
+    self.listeners.append(listener)
+
+  def addStatusListener(self, listener):
+    """ Registers a callback to be invoked when the stream connects or disconnects. """
+    self.status_listeners.append(listener)
+
+  def isConnected(self):
+    """ Returns whether the stream is currently connected to Docker. """
+    return self.connected
+
+  def start(self):
+    """ Starts reading the events stream. """
+    self.thread.start()
+
+  def readEvents(self):
+    """ Reads the events stream forever, reconnecting after RECONNECT_SLEEP_TIME seconds if
+        the stream fails.
+    """
+    while True:
+      try:
+        stream = getDockerClient().events()
+        self.setConnected(True)
+
+        for raw in stream:
+          if not isinstance(raw, dict):
+            raw = json.loads(raw)
+
+          self.dispatch(DockerEvent(raw))
+      except Exception as e:
+        self.logger.exception(e)
+
+      self.setConnected(False)
+      time.sleep(RECONNECT_SLEEP_TIME)
+
+  def setConnected(self, connected):
+    """ Updates the connection status of the stream, notifying the status listeners. """
+    if self.connected == connected:
+      return
+
+    self.logger.debug('Docker events stream connected: %s', connected)
+    self.connected = connected
+    for listener in self.status_listeners:
+      try:
+        listener(connected)
+      except Exception as e:
+        self.logger.exception(e)
+
+  def dispatch(self, event):
+    """ Dispatches the given event to all the listeners. """
+    self.logger.debug('Received Docker event %s %s for %s', event.kind, event.action, event.id)
+    for listener in self.listeners:
+      try:
+        listener(event)
+      except Exception as e:
+        self.logger.exception(e)
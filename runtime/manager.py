@@ -1,7 +1,13 @@
-from component import Component
-from metadata import getContainerStatus, setContainerStatus, removeContainerMetadata
-from proxy.portproxy import Proxy, Route
-from util import report, fail, getDockerClient, ReportLevels
+from component import Component, image_cache
+from metadata import (setContainerStatus, removeContainerMetadata, getContainerStatuses,
+                      setContainerStatuses, getKnownContainerIds, removeContainersMetadata,
+                      removeOrphanedMetadata)
+from snapshot import ContainerSnapshot
+from events import DockerEventStream, CONTAINER_EVENT
+from pull import PullManager
+from proxy.portproxy import Route
+from proxy.proxies import buildProxy
+from util import report, fail, getDockerClient, configureDockerClient, ReportLevels
 from health.checks import buildTerminationSignal, buildHealthCheck
 
 from collections import defaultdict
@@ -15,6 +21,12 @@ import time
 import logging
 import containerutil
 
+# The container event actions after which the container snapshot is stale.
+SNAPSHOT_INVALIDATING_ACTIONS = set(['start', 'die', 'destroy'])
+
+# The time, in seconds, proxy update requests are collected for before being applied together.
+PROXY_UPDATE_DELAY = 0.2
+
 class ComponentLinkInformation(object):
   """ Helper class which contains all runtime information about a component link. """
   def __init__(self, manager, component, link_config):
@@ -43,9 +55,7 @@ class ComponentLinkInformation(object):
     client = getDockerClient()
     container = component.getPrimaryContainer()
     if container:
-      container_ip = containerutil.getContainerIPAddress(client, container)
-
-      self.address = client.inspect_container(container)['NetworkSettings']['Gateway'] # The host's IP address.
+      self.address = containerutil.getContainerGateway(client, container) # The host's IP address.
       self.exposed_port = link_config.getHostPort()
       self.running = True
 
@@ -54,15 +64,38 @@ class RuntimeManager(object):
   """ Manager class which handles tracking of all the components and other runtime
       information.
   """
-  def __init__(self, config):
+  def __init__(self, config, project_name=None, in_daemon=False):
     # Logging.
     self.logger = logging.getLogger(__name__)
 
     # The overall configuration.
     self.config = config
 
-    # The proxy being used to talk to HAProxy.
-    self.proxy = Proxy()
+    # The name of the project being managed, if any. Used to label the containers created.
+    self.project_name = project_name
+
+    # The proxy routing the external ports to the containers.
+    self.proxy = buildProxy(config.proxy_engine, in_daemon)
+
+    # Apply the configured TTL to the image cache and settings to the docker client.
+    image_cache.ttl = config.image_cache_ttl
+    configureDockerClient(pool_size=config.docker_pool_size, timeouts=config.getDockerTimeouts())
+
+    # The shared snapshot of the gantry containers running under Docker.
+    self.container_snapshot = ContainerSnapshot(containerutil.buildLabelFilters(project_name),
+                                                legacy_filter=self.isLegacyContainer)
+
+    # The Docker events stream, used to invalidate the cached container inspections and
+    # snapshot, and to detect crashed containers.
+    self.events = DockerEventStream()
+    self.events.addListener(containerutil.handleContainerEvent)
+    self.events.addListener(self.handleContainerEvent)
+    self.events.addListener(image_cache.handleEvent)
+    self.events.addStatusListener(containerutil.handleEventStreamStatus)
+    self.events.start()
+
+    # The manager for the image pulls made on this host.
+    self.pulls = PullManager()
 
     # The components, by name.
     self.components = {}
@@ -71,6 +104,13 @@ class RuntimeManager(object):
     for component_config in config.components:
       self.components[component_config.name] = Component(self, component_config)
 
+    # The coalescing of proxy updates: the number of updates requested and applied so far, and
+    # whether an update is in progress.
+    self.proxy_condition = threading.Condition()
+    self.proxy_requested = 0
+    self.proxy_applied = 0
+    self.proxy_updating = False
+
     # Create the lock for the watcher thread and the notification event.
     self.watcher_lock = threading.Lock()
     self.watcher_event = threading.Event()
@@ -91,12 +131,49 @@ class RuntimeManager(object):
 
     return self.components[name]
 
+  def isLegacyContainer(self, container):
+    """ Returns whether the given container was started, without labels, by an earlier version
+        of gantry for one of the components.
+    """
+    if containerutil.getContainerLabel(container, containerutil.LABEL_COMPONENT):
+      return False
+
+    return any([component.ownsLegacyContainer(container)
+                for component in self.components.values()])
+
+  def getContainers(self, client):
+    """ Returns the containers found in the shared container snapshot. """
+    return self.container_snapshot.getContainers(client)
+
+  def invalidateContainers(self):
+    """ Invalidates the shared container snapshot. Must be called after a container has been
+        started, stopped or killed.
+    """
+    self.container_snapshot.invalidate()
+
+  def handleContainerEvent(self, event):
+    """ Invalidates the container snapshot when a container starts or dies outside of
+        gantry's control.
+    """
+    if event.kind == CONTAINER_EVENT and event.action in SNAPSHOT_INVALIDATING_ACTIONS:
+      self.invalidateContainers()
+
   def lookupComponentLink(self, link_name):
     """ Looks up the component link with the given name defined or None if none. """
+    component = self.lookupComponentLinkProvider(link_name)
+    if not component:
+      return None
+
+    defined_links = component.config.getDefinedComponentLinks()
+    return ComponentLinkInformation(self, component, defined_links[link_name])
+
+  def lookupComponentLinkProvider(self, link_name):
+    """ Looks up the component defining the component link with the given name or None if
+        none.
+    """
     for component_name, component in self.components.items():
-      defined_links = component.config.getDefinedComponentLinks()
-      if link_name in defined_links:
-        return ComponentLinkInformation(self, component, defined_links[link_name])
+      if link_name in component.config.getDefinedComponentLinks():
+        return component
 
     return None
 
@@ -105,13 +182,46 @@ class RuntimeManager(object):
         container.
     """
     self.logger.debug('Adjusting runtime for updating component: %s', component.getName())
-    self.updateProxy()
+    self.requestProxyUpdate()
 
   def adjustForStoppingComponent(self, component):
     """ Adjusts the runtime for a component which has been stopped.
     """
     self.logger.debug('Adjusting runtime for stopped component: %s', component.getName())
-    self.updateProxy()
+    self.requestProxyUpdate()
+
+  def requestProxyUpdate(self):
+    """ Updates the proxy, returning once an update started after this call has been applied.
+        Requests made while an update is pending or in progress are merged: the first caller
+        waits PROXY_UPDATE_DELAY seconds for others to arrive and then applies one update for
+        all of them.
+    """
+    with self.proxy_condition:
+      self.proxy_requested += 1
+      requested = self.proxy_requested
+      while self.proxy_updating and self.proxy_applied < requested:
+        self.proxy_condition.wait()
+
+      if self.proxy_applied >= requested:
+        return
+
+      self.proxy_updating = True
+
+    applied = None
+    try:
+      time.sleep(PROXY_UPDATE_DELAY)
+      with self.proxy_condition:
+        covered = self.proxy_requested
+
+      self.updateProxy()
+      applied = covered
+    finally:
+      with self.proxy_condition:
+        if applied is not None:
+          self.proxy_applied = max(self.proxy_applied, applied)
+
+        self.proxy_updating = False
+        self.proxy_condition.notify_all()
 
 
   def watchTermination(self, container, component):
@@ -159,9 +269,30 @@ class RuntimeManager(object):
     setContainerStatus(container, 'shutting-down')
     report('Shutting down container: ' + container['Id'][0:12], level=ReportLevels.BACKGROUND)
     client.stop(container)
+    self.invalidateContainers()
     removeContainerMetadata(container)
 
 
+  def collectMetadata(self):
+    """ Removes the metadata of the containers which no longer exist under Docker (including
+        containers not owned by gantry). Returns the number of containers removed.
+    """
+    # Read the known containers before listing the live ones, so that the metadata of a
+    # container created in between is never removed.
+    known_ids = getKnownContainerIds()
+
+    client = getDockerClient()
+    live_ids = set([container['Id'] for container in client.containers(all=True, quiet=True)])
+
+    stale_ids = list(known_ids - live_ids)
+    if stale_ids:
+      removeContainersMetadata(stale_ids)
+
+    orphaned = removeOrphanedMetadata()
+    self.logger.debug('Collected metadata of %s container(s) and %s orphaned field(s)',
+                      len(stale_ids), orphaned)
+    return len(stale_ids)
+
   def terminateContainer(self, container, component):
     """ Adds the given container to the list of containers which should be terminated.
     """
@@ -175,6 +306,9 @@ class RuntimeManager(object):
     """
     client = getDockerClient()
 
+    # Refresh the container snapshot once for this pass; all components share it below.
+    self.container_snapshot.refresh(client)
+
     # Clear all routes in the proxy.
     # TODO: When this is in daemon mode, don't need do this. We could selectively
     # edit it instead.
@@ -186,21 +320,31 @@ class RuntimeManager(object):
     draining_containers = []
     starting_containers = []
 
-    for component in self.components.values():
-      for container in component.getAllContainers(client):
-        if getContainerStatus(container) != 'draining':
+    component_containers = [(component, component.getAllContainers(client))
+                            for component in self.components.values()]
+
+    # Look up the status of all the containers at once.
+    statuses = getContainerStatuses([container for (_, containers) in component_containers
+                                     for container in containers])
+
+    for (component, containers) in component_containers:
+      for container in containers:
+        if statuses[container['Id']] != 'draining':
           container_ip = containerutil.getContainerIPAddress(client, container)
           starting_containers.append(container)
+          weight = component.getRouteWeight(container)
+          slow_start = component.config.slow_start
 
           # Add the normal exposed ports.
           for mapping in component.config.ports:
             route = Route(mapping.kind == 'http', mapping.external, container_ip,
-                          mapping.container)
+                          mapping.container, weight=weight, slow_start=slow_start)
             self.proxy.add_route(route)
 
           # Add the container link ports.
           for link in component.config.defined_component_links:
-            route = Route(link.kind == 'http', link.getHostPort(), container_ip, link.port)
+            route = Route(link.kind == 'http', link.getHostPort(), container_ip, link.port,
+                          weight=weight, slow_start=slow_start)
             self.proxy.add_route(route)
         else:
           draining_containers.append(container)
@@ -214,8 +358,7 @@ class RuntimeManager(object):
       self.proxy.shutdown()
 
     # Mark the starting containers as running.
-    for container in starting_containers:
-      setContainerStatus(container, 'running')
+    setContainerStatuses(starting_containers, 'running')
 
   def join(self):
     self.pool.close()
@@ -1,15 +1,39 @@
 import docker
 import json
+import os
+import time
+import threading
+import logging
+import atexit
 
-from peewee import (Model, SqliteDatabase, ForeignKeyField, CharField, OperationalError,
-                    sort_models_topologically, DoesNotExist)
+from peewee import Model, SqliteDatabase, ForeignKeyField, CharField, sort_models_topologically
 from functools import wraps
+from Queue import Queue, Empty
 
 GANTRY_METADATA_FILE = '.gantry_metadata'
-cached_metadata = None
 
+# The maximum number of container IDs bound in a single query (SQLite allows 999 variables).
+MAX_QUERY_IDS = 500
 
-db = SqliteDatabase(GANTRY_METADATA_FILE)
+# The maximum number of queued writes grouped into a single commit.
+MAX_WRITE_BATCH = 100
+
+# The maximum number of seconds to wait for the queued writes to be committed when flushing.
+FLUSH_TIMEOUT = 10
+
+# The minimum number of seconds between checks for changes made to the database by other
+# processes (e.g. gantry.py stopping a component managed by gantryd).
+CACHE_CHECK_INTERVAL = 2
+
+
+# The database keeps one connection open per thread (reused across calls), in WAL mode so that
+# readers do not block on the writer.
+db = SqliteDatabase(GANTRY_METADATA_FILE, threadlocals=True,
+                    pragmas=(('journal_mode', 'wal'), ('synchronous', 'normal')))
+
+# Whether the schema has been created by this process.
+db_initialized = False
+db_initialize_lock = threading.Lock()
 
 
 class BaseModel(Model):
@@ -48,75 +72,431 @@ class ContainerField(BaseModel):
 all_models = [Component, ComponentField, Container, ContainerField]
 
 
-def _initialze_db():
-  for model in sort_models_topologically(all_models):
-    try:
-      model.select().get()
-    except OperationalError as exc:
-      model.create_table()
-    except DoesNotExist:
-      pass
+def _initialize_db():
+  """ Creates any missing tables, once per process. """
+  global db_initialized
+  if db_initialized:
+    return
+
+  with db_initialize_lock:
+    if not db_initialized:
+      db.create_tables(sort_models_topologically(all_models), safe=True)
+      db_initialized = True
 
 
 def db_access(to_wrap):
   @wraps(to_wrap)
   def wrapper(*args, **kwargs):
-    _initialze_db()
-
-    try:
-      return to_wrap(*args, **kwargs)
-    finally:
-      if not db.is_closed():
-        db.close()
+    _initialize_db()
+    return to_wrap(*args, **kwargs)
 
   return wrapper
 
 
+class PendingWrite(object):
+  """ A write queued to the metadata writer. """
+  def __init__(self, func, args):
+    self.func = func
+    self.args = args
+    self.result = None
+    self.done = threading.Event()
+
+  def apply(self):
+    """ Applies the write to the database. """
+    self.result = self.func(*self.args)
+
+  def wait(self, timeout=None):
+    """ Waits for the write to be committed, returning its result. """
+    self.done.wait(timeout)
+    return self.result
+
+
+class MetadataWriter(object):
+  """ Applies all the writes to the metadata database on a single dedicated thread, so that
+      writers never contend for the database lock. The writes queued while a commit is in
+      progress are grouped into the next commit (up to MAX_WRITE_BATCH writes), so a write
+      waits for at most the commit in progress and its own.
+  """
+  def __init__(self):
+    # Logging.
+    self.logger = logging.getLogger(__name__)
+
+    # The queue of PendingWrite's to apply, in order.
+    self.queue = Queue()
+
+    # The writer thread, started on the first write.
+    self.thread = None
+    self.lock = threading.Lock()
+
+    # The last PendingWrite queued. Writes are committed in order, so once it is done, so are
+    # all the writes queued before it.
+    self.last_write = None
+
+    # Whether a write failed since the metadata cache was last loaded, so the cache (already
+    # updated with the write) no longer matches the database.
+    self.write_failed = False
+
+  def submit(self, func, *args):
+    """ Queues the given write, returning its PendingWrite. """
+    with self.lock:
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run, args=[])
+        self.thread.daemon = True
+        self.thread.start()
+
+      write = PendingWrite(func, args)
+      self.queue.put(write)
+      self.last_write = write
+
+    return write
+
+  def getQueueDepth(self):
+    """ Returns the number of writes waiting to be committed. """
+    return self.queue.qsize()
+
+  def isIdle(self):
+    """ Returns whether all the queued writes have been committed (or have failed). """
+    write = self.last_write
+    return write is None or write.done.is_set()
+
+  def flush(self, timeout=FLUSH_TIMEOUT):
+    """ Waits until all the queued writes have been committed, for at most the given number of
+        seconds. Returns False if some writes are still pending.
+    """
+    write = self.last_write
+    if write is None:
+      return True
+
+    if not write.done.wait(timeout):
+      self.logger.warning('Gave up waiting for %s pending metadata writes', self.getQueueDepth())
+      return False
+
+    return True
+
+  def run(self):
+    """ Commits the queued writes, forever. """
+    while True:
+      batch = [self.queue.get()]
+      while len(batch) < MAX_WRITE_BATCH:
+        try:
+          batch.append(self.queue.get_nowait())
+        except Empty:
+          break
+
+      # Never let a failure (e.g. the database cannot be opened) stop the writer thread: the
+      # failed writes are dropped, and the next ones are tried again.
+      try:
+        self.commit(batch)
+      except Exception as e:
+        self.logger.exception(e)
+        self.write_failed = True
+      finally:
+        for write in batch:
+          write.done.set()
+          self.queue.task_done()
+
+  @db_access
+  def commit(self, batch):
+    """ Applies the given writes in a single transaction. If the transaction fails, the writes
+        are retried one at a time, so that a single failing write does not lose the others.
+    """
+    try:
+      with db.atomic():
+        for write in batch:
+          write.apply()
+      return
+    except Exception as e:
+      self.logger.exception(e)
+      if len(batch) == 1:
+        self.write_failed = True
+        return
+
+    for write in batch:
+      try:
+        write.apply()
+      except Exception as e:
+        self.logger.exception(e)
+        self.write_failed = True
+
+
+metadata_writer = MetadataWriter()
+
+# Make sure the queued writes are committed before the process exits.
+atexit.register(metadata_writer.flush)
+
+
+class MetadataCache(object):
+  """ An in-memory, write-through copy of the metadata, loaded from the database on first use.
+      Reads are served from memory; writes update the copy and are queued to the metadata
+      writer, under a lock shared by all threads, so readers always see their own writes.
+      Other processes may write the metadata too: at most every CACHE_CHECK_INTERVAL seconds,
+      the copy is reloaded if the database files changed and none of this process' writes are
+      still pending. A failed write forces a reload as soon as the pending writes are done.
+  """
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.loaded = False
+
+    # When the database files were last checked for changes, and their signature then.
+    self.checked_at = 0
+    self.db_signature = None
+
+    # The name of the component owning each known container (or None), by container ID.
+    self.container_components = {}
+
+    # The fields of each known container, by container ID.
+    self.container_fields = {}
+
+    # The fields of each known component, by component name.
+    self.component_fields = {}
+
+  def ensureLoaded(self):
+    """ Loads the metadata from the database, if not already loaded, or reloads it if the
+        database has changed since or a write to it failed.
+    """
+    if self.isFresh():
+      return
+
+    with self.lock:
+      if self.isFresh():
+        return
+
+      self.checked_at = time.time()
+      signature = _dbSignature()
+      if self.loaded and signature == self.db_signature and not metadata_writer.write_failed:
+        return
+
+      # A reload would lose the writes of this process which are not committed yet, so it
+      # waits for the next check.
+      if self.loaded and not metadata_writer.isIdle():
+        return
+
+      self.load()
+      self.loaded = True
+      self.db_signature = signature
+      metadata_writer.write_failed = False
+
+  def isFresh(self):
+    """ Returns whether the loaded metadata can be used without checking the database. """
+    return (self.loaded and not metadata_writer.write_failed and
+            time.time() - self.checked_at < CACHE_CHECK_INTERVAL)
+
+  @db_access
+  def load(self):
+    """ Loads all the metadata from the database. """
+    component_names = dict(Component.select(Component.id, Component.name).tuples())
+
+    self.container_components = {}
+    for (container_id, component_id) in (Container
+        .select(Container.docker_id, Container.component)
+        .tuples()):
+      self.container_components[container_id] = component_names.get(component_id)
+
+    self.container_fields = {}
+    for (container_id, key, value) in (ContainerField
+        .select(Container.docker_id, ContainerField.key, ContainerField.value)
+        .join(Container)
+        .tuples()):
+      self.container_fields.setdefault(container_id, {})[key] = value
+
+    self.component_fields = {}
+    for (component_name, key, value) in (ComponentField
+        .select(Component.name, ComponentField.key, ComponentField.value)
+        .join(Component)
+        .tuples()):
+      self.component_fields.setdefault(component_name, {})[key] = value
+
+  def getContainerFields(self, container_ids, field, default):
+    """ Returns a dict of the field for the given containers (or the default value), by
+        container ID.
+    """
+    self.ensureLoaded()
+    with self.lock:
+      return {container_id: self.container_fields.get(container_id, {}).get(field, default)
+              for container_id in container_ids}
+
+  def setContainerFields(self, container_ids, field, value):
+    """ Sets the field for the given containers. """
+    self.ensureLoaded()
+    with self.lock:
+      metadata_writer.submit(_setContainerFields, list(container_ids), field, value)
+      for container_id in container_ids:
+        self.container_components.setdefault(container_id, None)
+        self.container_fields.setdefault(container_id, {})[field] = _dbValue(ContainerField,
+                                                                              value)
+
+  def getContainerComponents(self, container_ids):
+    """ Returns a dict of the names of the components owning the given containers (or None),
+        by container ID.
+    """
+    self.ensureLoaded()
+    with self.lock:
+      return {container_id: self.container_components.get(container_id)
+              for container_id in container_ids}
+
+  def setContainerComponent(self, container_id, component_name):
+    """ Sets the component owning the given container. """
+    self.ensureLoaded()
+    with self.lock:
+      metadata_writer.submit(_setContainerComponent, container_id, component_name)
+      self.container_components[container_id] = component_name
+      self.component_fields.setdefault(component_name, {})
+
+  def getContainerIds(self):
+    """ Returns the set of IDs of the containers with metadata. """
+    self.ensureLoaded()
+    with self.lock:
+      return set(self.container_components.keys()) | set(self.container_fields.keys())
+
+  def removeContainers(self, container_ids):
+    """ Removes all the metadata of the given containers, in a single transaction. """
+    self.ensureLoaded()
+    with self.lock:
+      metadata_writer.submit(_removeContainersMetadata, list(container_ids))
+      for container_id in container_ids:
+        self.container_components.pop(container_id, None)
+        self.container_fields.pop(container_id, None)
+
+  def getComponentField(self, component_name, field, default):
+    """ Returns the field for the given component or the default value. """
+    self.ensureLoaded()
+    with self.lock:
+      return self.component_fields.get(component_name, {}).get(field, default)
+
+  def setComponentField(self, component_name, field, value):
+    """ Sets the field for the given component. """
+    self.ensureLoaded()
+    with self.lock:
+      metadata_writer.submit(_setComponentField, component_name, field, value)
+      self.component_fields.setdefault(component_name, {})[field] = _dbValue(ComponentField,
+                                                                             value)
+
+
+metadata_cache = MetadataCache()
+
+
 def getContainerStatus(container):
   """ Returns the status code of the given container. """
-  return _getContainerField(container, 'status', default='unknown')
+  container_id = _getContainerId(container)
+  return metadata_cache.getContainerFields([container_id], 'status', 'unknown')[container_id]
 
 
 def setContainerStatus(container, status):
   """ Sets the status code for the given container. """
-  _setContainerField(container, 'status', status)
+  metadata_cache.setContainerFields([_getContainerId(container)], 'status', status)
 
 
-@db_access
 def getContainerComponent(container):
   """ Returns the component that owns the given container. """
-  container_record = _upsertContainerRecord(container)
-  return container_record.component and container_record.component.name
+  container_id = _getContainerId(container)
+  return metadata_cache.getContainerComponents([container_id])[container_id]
 
 
-@db_access
 def setContainerComponent(container, component_name):
   """ Sets the component code for the given container. """
-  component = _upsertComponentRecord(component_name)
-  container_record = _upsertContainerRecord(container)
-  container_record.component = component
-  container_record.save()
+  metadata_cache.setContainerComponent(_getContainerId(container), component_name)
+
+
+def getContainerStatuses(containers):
+  """ Returns a dict of the status codes of the given containers, by container ID. """
+  return metadata_cache.getContainerFields(_getContainerIds(containers), 'status', 'unknown')
+
+
+def setContainerStatuses(containers, status):
+  """ Sets the status code for all the given containers, in a single transaction. """
+  metadata_cache.setContainerFields(_getContainerIds(containers), 'status', status)
+
+
+def getContainerComponents(containers):
+  """ Returns a dict of the names of the components owning the given containers (or None),
+      by container ID.
+  """
+  return metadata_cache.getContainerComponents(_getContainerIds(containers))
+
+
+def removeContainerMetadata(container):
+  """ Removes all the metadata of the given container. """
+  metadata_cache.removeContainers([_getContainerId(container)])
+
+
+def removeContainersMetadata(containers):
+  """ Removes all the metadata of the given containers, in a single transaction. """
+  metadata_cache.removeContainers(_getContainerIds(containers))
+
+
+def getKnownContainerIds():
+  """ Returns the set of IDs of the containers with metadata. """
+  return metadata_cache.getContainerIds()
+
+
+def removeOrphanedMetadata():
+  """ Removes the container fields left behind by containers whose record no longer exists.
+      Returns the number of rows removed.
+  """
+  return metadata_writer.submit(_removeOrphanedMetadata).wait()
+
+
+def getWriteQueueDepth():
+  """ Returns the number of metadata writes waiting to be committed. """
+  return metadata_writer.getQueueDepth()
+
+
+def flushMetadataWrites():
+  """ Waits until all the queued metadata writes have been committed (for a bounded time).
+      Returns False if some writes are still pending.
+  """
+  return metadata_writer.flush()
+
+
+def getComponentField(component_name, field, default):
+  """ Returns the metadata field for the given component or the default value. """
+  return metadata_cache.getComponentField(component_name, field, default)
+
+
+def setComponentField(component_name, field, value):
+  """ Sets the metadata field for the given component. """
+  metadata_cache.setComponentField(component_name, field, value)
+
+
+def _dbSignature():
+  """ Returns the modification times and sizes of the database files, which change whenever a
+      transaction is committed to the database.
+  """
+  signature = []
+  for path in [GANTRY_METADATA_FILE, GANTRY_METADATA_FILE + '-wal']:
+    try:
+      stat = os.stat(path)
+      signature.append((stat.st_mtime, stat.st_size))
+    except OSError:
+      signature.append(None)
+
+  return tuple(signature)
 
 
 def _getContainerId(container_or_id):
   return container_or_id['Id'] if isinstance(container_or_id, dict) else container_or_id
 
 
-@db_access
-def removeContainerMetadata(container):
-  found = _upsertContainerRecord(container)
-  found.delete_instance(recursive=True)
+def _getContainerIds(containers):
+  """ Returns the unique IDs of the given containers, in order. """
+  container_ids = []
+  for container in containers:
+    container_id = _getContainerId(container)
+    if not container_id in container_ids:
+      container_ids.append(container_id)
 
+  return container_ids
+
+
+def _chunked(container_ids):
+  """ Splits the given container IDs into chunks small enough to be bound in a query. """
+  return [container_ids[index:index + MAX_QUERY_IDS]
+          for index in range(0, len(container_ids), MAX_QUERY_IDS)]
 
-def _getContainerFieldRecord(container, field):
-  try:
-    return (ContainerField
-      .select()
-      .join(Container)
-      .where(Container.docker_id == container, ContainerField.key == field)
-      .get())
-  except ContainerField.DoesNotExist:
-    return None
+
+def _dbValue(model, value):
+  """ Returns the given field value as stored in (and thus read back from) the database. """
+  return model.value.db_value(value)
 
 
 def _upsertContainerRecord(container):
@@ -131,24 +511,67 @@ def _upsertContainerRecord(container):
 
 
 @db_access
-def _getContainerField(container, field, default):
-  """ Returns the metadata field for the given container or the default value. """
-  container_id = _getContainerId(container)
-  found = _getContainerFieldRecord(container_id, field)
-  return found.value if found else default
+def _setContainerComponent(container, component_name):
+  component = _upsertComponentRecord(component_name)
+  container_record = _upsertContainerRecord(container)
+  container_record.component = component
+  container_record.save()
 
 
 @db_access
-def _setContainerField(container, field, value):
-  """ Sets the metadata field for the given container. """
-  container_id = _getContainerId(container)
-  found = _getContainerFieldRecord(container_id, field)
-  if found is not None:
-    found.value = value
-    found.save()
-  else:
-    container_record = _upsertContainerRecord(container_id)
-    ContainerField.create(container=container_record, key=field, value=value)
+def _removeOrphanedMetadata():
+  return (ContainerField
+    .delete()
+    .where(ContainerField.container.not_in(Container.select(Container.id)))
+    .execute())
+
+
+@db_access
+def _removeContainersMetadata(container_ids):
+  with db.atomic():
+    for chunk in _chunked(container_ids):
+      record_ids = [row[0] for row in (Container
+        .select(Container.id)
+        .where(Container.docker_id << chunk)
+        .tuples())]
+
+      if record_ids:
+        ContainerField.delete().where(ContainerField.container << record_ids).execute()
+        Container.delete().where(Container.id << record_ids).execute()
+
+
+@db_access
+def _setContainerFields(containers, field, value):
+  """ Sets the metadata field for all the given containers, in a single transaction. """
+  container_ids = _getContainerIds(containers)
+  with db.atomic():
+    for chunk in _chunked(container_ids):
+      # Find (or create) the container records.
+      records = {}
+      for record in Container.select().where(Container.docker_id << chunk):
+        records[record.docker_id] = record
+
+      for container_id in chunk:
+        if not container_id in records:
+          records[container_id] = Container.create(docker_id=container_id)
+
+      # Update the existing fields and create the missing ones.
+      record_ids = [record.id for record in records.values()]
+      existing = set([row[0] for row in (ContainerField
+        .select(ContainerField.container)
+        .where(ContainerField.container << record_ids, ContainerField.key == field)
+        .tuples())])
+
+      if existing:
+        (ContainerField
+          .update(value=value)
+          .where(ContainerField.container << list(existing), ContainerField.key == field)
+          .execute())
+
+      missing = [{'container': record_id, 'key': field, 'value': value}
+                 for record_id in record_ids if not record_id in existing]
+      if missing:
+        ContainerField.insert_many(missing).execute()
 
 
 def _upsertComponentRecord(component):
@@ -173,15 +596,7 @@ def _getComponentFieldRecord(component_name, field):
 
 
 @db_access
-def getComponentField(component_name, field, default):
-  """ Returns the metadata field for the given component or the default value. """
-  found = _getComponentFieldRecord(component_name, field)
-  return found.value if found else default
-
-
-@db_access
-def setComponentField(component_name, field, value):
-  """ Sets the metadata field for the given component. """
+def _setComponentField(component_name, field, value):
   found = _getComponentFieldRecord(component_name, field)
   if found is not None:
     found.value = value
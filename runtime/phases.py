@@ -0,0 +1,65 @@
+from contextlib import contextmanager
+from threading import Thread
+
+import sys
+import time
+
+class PhaseTimer(object):
+  """ Records the wall-clock duration of each named phase of an operation (such as a
+      component update), in the order in which the phases ran.
+  """
+  def __init__(self):
+    self.start_time = time.time()
+
+    # The (name, duration in seconds) pairs of the phases that have run.
+    self.phases = []
+
+  @contextmanager
+  def phase(self, name):
+    """ Times the phase with the given name, run under this context. """
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.phases.append((name, time.time() - start))
+
+  def getTotalTime(self):
+    """ Returns the time, in seconds, since the timer was created. """
+    return time.time() - self.start_time
+
+  def getSummary(self):
+    """ Returns a human readable summary of the phase durations. """
+    pieces = ['%s: %.2fs' % (name, duration) for (name, duration) in self.phases]
+    return '%.2fs (%s)' % (self.getTotalTime(), ', '.join(pieces))
+
+
+def runInParallel(*calls):
+  """ Runs the given callables on their own threads, waits for all of them and returns their
+      results, in order. If any of them raised, the first such exception is re-raised.
+  """
+  results = [None] * len(calls)
+  errors = [None] * len(calls)
+
+  def run(index):
+    try:
+      results[index] = calls[index]()
+    except Exception:
+      errors[index] = sys.exc_info()
+
+  threads = [Thread(target=run, args=[index]) for index in range(1, len(calls))]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+
+  # Run the first call on the current thread.
+  if calls:
+    run(0)
+
+  for thread in threads:
+    thread.join()
+
+  for error in errors:
+    if error is not None:
+      raise error[0], error[1], error[2]
+
+  return results
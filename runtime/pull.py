@@ -0,0 +1,180 @@
+import json
+import threading
+import time
+import logging
+
+from util import report, getDockerClient, ReportLevels
+
+MAX_CONCURRENT_PULLS = 2
+PROGRESS_REPORT_INTERVAL = 10 # 10 seconds
+
+class PullOperation(object):
+  """ A single pull of a repo:tag, shared by all the callers which requested it while it was
+      running. Tracks the progress of the pull as reported by Docker.
+  """
+  def __init__(self, repo, tag):
+    self.repo = repo
+    self.tag = tag
+
+    # Set once the pull has completed (successfully or not).
+    self.done = threading.Event()
+
+    # Whether the pull succeeded and the error message if it did not.
+    self.succeeded = False
+    self.error = None
+
+    # The progress of each layer being downloaded, by layer ID: (current, total) bytes.
+    self.layers = {}
+
+    # The times at which the pull started and finished.
+    self.start_time = None
+    self.end_time = None
+
+  def getFullImage(self):
+    """ Returns the named image being pulled, of the form 'repo:tag'. """
+    return self.repo + ':' + self.tag
+
+  def getProgress(self):
+    """ Returns the number of bytes downloaded and the total number of bytes to download,
+        as known so far.
+    """
+    layers = self.layers.values()
+    return (sum([current for (current, total) in layers]),
+            sum([total for (current, total) in layers]))
+
+  def getThroughput(self):
+    """ Returns the throughput of the pull, in bytes per second. """
+    if self.start_time is None:
+      return 0
+
+    elapsed = (self.end_time or time.time()) - self.start_time
+    if elapsed <= 0:
+      return 0
+
+    return self.getProgress()[0] / elapsed
+
+  def updateProgress(self, status):
+    """ Updates the progress of the pull from a status line sent by Docker. """
+    if 'error' in status:
+      self.error = status['error']
+      return
+
+    layer_id = status.get('id')
+    detail = status.get('progressDetail') or {}
+    if not layer_id:
+      return
+
+    if 'total' in detail:
+      self.layers[layer_id] = (detail.get('current', 0), detail['total'])
+    elif status.get('status') in ('Download complete', 'Pull complete') and layer_id in self.layers:
+      total = self.layers[layer_id][1]
+      self.layers[layer_id] = (total, total)
+
+  def wait(self):
+    """ Waits for the pull to complete and returns whether it succeeded. """
+    self.done.wait()
+    return self.succeeded
+
+
+class PullManager(object):
+  """ Host-wide manager of image pulls. Concurrent pulls of the same repo:tag are merged into
+      a single pull, and at most MAX_CONCURRENT_PULLS pulls run at the same time.
+  """
+  def __init__(self, max_concurrent_pulls=MAX_CONCURRENT_PULLS):
+    # Logging.
+    self.logger = logging.getLogger(__name__)
+
+    # The pulls currently running (or waiting to run), by named image.
+    self.operations = {}
+    self.lock = threading.Lock()
+
+    # Limits the number of pulls running at the same time.
+    self.semaphore = threading.Semaphore(max_concurrent_pulls)
+
+  def getOperations(self):
+    """ Returns the pulls currently running or waiting to run. """
+    with self.lock:
+      return self.operations.values()
+
+  def pull(self, repo, tag, component=None):
+    """ Pulls the given repo:tag, waiting for any pull of it already running instead of
+        starting a new one. Returns whether the pull succeeded.
+    """
+    key = repo + ':' + tag
+    with self.lock:
+      operation = self.operations.get(key)
+      is_owner = operation is None
+      if is_owner:
+        operation = PullOperation(repo, tag)
+        self.operations[key] = operation
+
+    if not is_owner:
+      report('Waiting for running pull of image ' + key, component=component)
+      return operation.wait()
+
+    try:
+      with self.semaphore:
+        self.runPull(operation, component)
+    finally:
+      with self.lock:
+        del self.operations[key]
+
+      operation.done.set()
+
+    return operation.succeeded
+
+  def runPull(self, operation, component):
+    """ Runs the given pull, reporting its progress every PROGRESS_REPORT_INTERVAL seconds. """
+    full_image = operation.getFullImage()
+    self.logger.debug('Pulling image %s', full_image)
+    operation.start_time = time.time()
+    last_report = operation.start_time
+
+    try:
+      client = getDockerClient()
+      for line in client.pull(operation.repo, tag=operation.tag, stream=True):
+        for status in self.parseStatuses(line):
+          operation.updateProgress(status)
+
+        if time.time() - last_report >= PROGRESS_REPORT_INTERVAL:
+          last_report = time.time()
+          self.reportProgress(operation, component)
+
+      operation.succeeded = operation.error is None
+    except Exception as e:
+      self.logger.exception(e)
+      operation.error = str(e)
+
+    operation.end_time = time.time()
+    if operation.succeeded:
+      report('Pulled image %s in %.1fs (%.1f MB/s)' % (full_image,
+                                                        operation.end_time - operation.start_time,
+                                                        operation.getThroughput() / 1048576.0),
+             component=component, level=ReportLevels.EXTRA)
+    else:
+      report('Pull of image %s failed: %s' % (full_image, operation.error), component=component,
+             level=ReportLevels.IMPORTANT)
+
+  def reportProgress(self, operation, component):
+    """ Reports the progress of the given pull. """
+    (current, total) = operation.getProgress()
+    report('Pulling image %s: %.1f/%.1f MB (%.1f MB/s)' % (operation.getFullImage(),
+                                                            current / 1048576.0,
+                                                            total / 1048576.0,
+                                                            operation.getThroughput() / 1048576.0),
+           component=component, level=ReportLevels.BACKGROUND)
+
+  def parseStatuses(self, line):
+    """ Parses the JSON status objects found in a chunk of the pull stream. """
+    statuses = []
+    for piece in line.splitlines():
+      piece = piece.strip()
+      if not piece:
+        continue
+
+      try:
+        statuses.append(json.loads(piece))
+      except ValueError:
+        self.logger.debug('Could not parse pull status: %s', piece)
+
+    return statuses
@@ -0,0 +1,73 @@
+import threading
+import time
+import logging
+
+SNAPSHOT_LIFETIME = 2 # 2 seconds
+
+class ContainerSnapshot(object):
+  """ A short-lived listing of the containers known to Docker, shared by all the components
+      managed by a RuntimeManager. The listing is refreshed at most once per reconcile pass
+      (or once every SNAPSHOT_LIFETIME seconds) and must be invalidated whenever a container
+      is started, stopped or killed.
+  """
+  def __init__(self, label_filters, legacy_filter=None, lifetime=SNAPSHOT_LIFETIME):
+    # Logging.
+    self.logger = logging.getLogger(__name__)
+
+    # The label filters applied (server-side) when listing the containers.
+    self.label_filters = label_filters
+
+    # The function selecting the unlabelled containers (started by gantry versions which did
+    # not label their containers) to include in the snapshot, if any.
+    self.legacy_filter = legacy_filter
+
+    # Whether unlabelled containers may still be running. Gantry no longer starts any, so the
+    # containers stop being listed in full once none of them is left.
+    self.include_legacy = legacy_filter is not None
+
+    # The maximum age, in seconds, of the snapshot before it is considered stale.
+    self.lifetime = lifetime
+
+    # The lock protecting the snapshot. Held while listing, so that concurrent callers
+    # share a single call to Docker.
+    self.lock = threading.Lock()
+
+    # The cached container list (None if invalid) and the time at which it was taken.
+    self.containers = None
+    self.timestamp = 0
+
+  def getContainers(self, client):
+    """ Returns the containers in the snapshot, listing them from Docker if the snapshot is
+        missing or stale.
+    """
+    with self.lock:
+      if self.containers is None or time.time() - self.timestamp > self.lifetime:
+        self._load(client)
+
+      return list(self.containers)
+
+  def refresh(self, client):
+    """ Forces the snapshot to be reloaded from Docker and returns the containers found. """
+    with self.lock:
+      self._load(client)
+      return list(self.containers)
+
+  def invalidate(self):
+    """ Invalidates the snapshot, forcing the next lookup to list the containers again. """
+    with self.lock:
+      self.containers = None
+
+  def _load(self, client):
+    self.logger.debug('Listing containers for snapshot')
+    containers = client.containers(filters={'label': self.label_filters})
+    if self.include_legacy:
+      legacy_containers = [container for container in client.containers()
+                           if self.legacy_filter(container)]
+      if legacy_containers:
+        self.logger.debug('Found %s unlabelled container(s)', len(legacy_containers))
+
+      self.include_legacy = bool(legacy_containers)
+      containers.extend(legacy_containers)
+
+    self.containers = containers
+    self.timestamp = time.time()
@@ -1,8 +1,8 @@
-import docker
 import datetime
 import socket
 
 from termcolor import colored, cprint
+from dockerclient import DockerClientPool, PooledDockerClient
 
 def enum(*sequential, **named):
     """ Represent an enumeration. Originally from: http://stackoverflow.com/questions/36932/whats-the-best-way-to-implement-an-enum-in-python """
@@ -11,7 +11,8 @@ def enum(*sequential, **named):
 
 ReportLevels = enum(BACKGROUND=-2, EXTRA=-1, NORMAL=0, IMPORTANT=1)
 
-client = docker.Client(version='auto')
+docker_pool = DockerClientPool()
+client = PooledDockerClient(docker_pool)
 
 def pickUnusedPort():
   s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -46,5 +47,15 @@ def fail(reason, project=None, component=None, exception=None):
   raise Exception(reason)
 
 def getDockerClient():
-  """ Returns the docker client. """
-  return client
\ No newline at end of file
+  """ Returns the docker client. The client is thread-safe. """
+  return client
+
+def configureDockerClient(pool_size=None, timeouts=None):
+  """ Configures the size of the docker client pool and/or the timeouts, in seconds, of
+      specific Docker API operations.
+  """
+  docker_pool.configure(size=pool_size, timeouts=timeouts)
+
+def getDockerCallStats():
+  """ Returns the call statistics of the Docker API operations, by operation. """
+  return docker_pool.getStats()
\ No newline at end of file